@@ -1,15 +1,20 @@
 #! /usr/bin/env python
 
+import argparse
 import configparser
 import datetime
 import logging
+import numpy
 import os.path
-import pandas
+import re
 import sys
 
 from base import *
-import islands
+import output
 import process
+import provenance
+import reader
+import store
 import taxonomy
 
 def main(args):
@@ -22,56 +27,77 @@ def main(args):
 	if not os.path.isfile(conffile): raise RuntimeError(f"Can't open configuration file {conffile!r}")
 	config.read(conffile)
 	#if not process.test(): raise RuntimeError("Tests failed")
-	islands.init(config.get("input", "geometry"))
+	process.init(config)
 	stats = process.ResolverStat.create()
-	resolver = process.LocationProcessor()
-	chooser = process.Prioritizer()
-	mapper = taxonomy.ObservationMapper(config.get("input", "taxonomy"))
+	classes = [ cls.strip() for cls in re.split(r"[,\n]", config.get("output", "classes", fallback="")) if cls.strip() != "" ]
+	mapper = taxonomy.ObservationMapper(config.get("input", "taxonomy"), classes)
+	results_store = None
+	if config.get("cache", "results", fallback=""):
+		results_store = store.ResultStore(config.get("cache", "results"), process.RESOLVERS + [process.Prefilter, process.LocationProcessor],
+			process.input_columns())
 
 	# Read and process data
 	print("Reading GBIF")
-	if len(args) > 2: raise RuntimeError("At most one argument is allowed.  Usage analyze.py [data-file.tsv]")
-	datafile = args[1] if len(args) > 1 else config.get("input", "gbif")
-	data = {}
-	# on_bad_lines='skip': silently drop rows whose field count doesn't match the header.
-	# This can happen when concatenating GBIF downloads from different years that have
-	# slightly different column sets, or when a text field contains a stray tab character.
-	for (_, row) in pandas.read_csv(datafile, sep="\t", quoting=3, dtype=str, na_filter=False, on_bad_lines='skip').iterrows():
-		data[row["gbifID"]] = row
+	parser = argparse.ArgumentParser(prog="analyze.py")
+	parser.add_argument("--workers", type=int, default=1, help="number of worker processes to resolve rows with")
+	parser.add_argument("datafile", nargs="?", default=config.get("input", "gbif"), help="GBIF extract to analyze")
+	args = parser.parse_args(args[1:])
+	datafile = args.datafile
+	columns = ["gbifID"] + process.input_columns() + taxonomy.ObservationMapper.columns
+	provenance_filter = None
+	if config.get("provenance", "specimens", fallback=""):
+		provenance_filter = provenance.ProvenanceFilter(config.get("provenance", "specimens"), config.get("provenance", "unresolved"),
+			[ resolver.name for resolver in process.RESOLVERS ], config.getfloat("provenance", "cutoff", fallback=-88.0))
+		# The filtered records are written out with every input column unless told otherwise.
+		extra = [ col.strip() for col in config.get("provenance", "columns", fallback="").split(",") if col.strip() != "" ]
+		columns = columns + provenance.ProvenanceFilter.columns + extra if extra else None
+	# Rows of taxa we aren't interested in are never resolved: they can be dropped as they are read, or skipped, so that they still
+	# appear in the results.
+	taxa = [ taxon.strip() for taxon in re.split(r"[,\n]", config.get("taxa", "include", fallback="")) if taxon.strip() != "" ]
+	other = config.get("taxa", "other", fallback="drop")
+	if other not in ("drop", "skip"): raise RuntimeError(f"Unknown value {other!r} for other in [taxa]; expected drop or skip")
+	taxon_filter = taxonomy.TaxonFilter(taxa) if taxa else None
+	if taxon_filter is not None and columns is not None: columns = columns + taxonomy.TaxonFilter.columns
+	skip = (lambda chunk: ~taxon_filter(chunk)) if taxon_filter is not None and other == "skip" else None
+	data = reader.GbifReader(datafile, config.getint("input", "chunksize", fallback=10000), columns, taxon_filter if other == "drop" else None)
 	tot = len(data)
 	processed = 0
 	resolved = 0
-	skipped = 0
-	results = []
-	print(f"Read {len(data)} rows from {datafile}")
-	for row in data.values():
-		processed += 1
-		#if not mapper.should_include(row):
-		#	skipped += 1
-		#	continue
-		res = resolver.resolve(row, stats)
-		best = chooser.choose(row, res, stats)
-		if best != UNKNOWN: resolved += 1
-		best_by_resolver = chooser.best_by_resolver(res)
-		best_locs_by_resolver = [ best_by_resolver.get(resolver.name, UNKNOWN).loc or "-" for resolver in process.RESOLVERS ]
-		if best.loc is not None: mapper.add(row, best.loc)
-		result = [int(row["gbifID"])] + best_locs_by_resolver + [best.loc or "-", taxonomy.most_specific_taxon(row) or "-"]
-		results.append(result)
-		if processed % 100 == 0: print(f"\r{processed}/{tot}", end="")
+	header = ["gbifID"] + [ resolver.name for resolver in process.RESOLVERS ] + ["best", "species"]
+	results = output.ResultBuffer(
+		output.open_results(config.get("output", "results"), header, config.getboolean("output", "partition", fallback=False)),
+		header, config.getint("output", "buffer", fallback=100000))
+	errors = output.ErrorSink(config.get("output", "errors"), config.get("output", "error_rows", fallback=""))
+	print(f"Found {tot} records in {datafile}")
+	for (chunk, outcomes) in process.process_chunks(data, stats, args.workers, config, results_store, skip):
+		# With the provenance filter, only the records it keeps are counted on their islands, and those it finds to be from the
+		# Galápagos without an island are counted for the archipelago as a whole.
+		(kept, unresolved) = ([True] * len(chunk), [False] * len(chunk))
+		if provenance_filter is not None: (kept, unresolved) = provenance_filter.add(chunk, outcomes)
+		places = [ best_loc if best_loc is not None and keep else mapper.archipelago if archipelago else None
+			for ((_, best_loc, _), keep, archipelago) in zip(outcomes, kept, unresolved) ]
+		mapper.add_many(chunk, places)
+		results.add_many(chunk["gbifID"].to_numpy().astype(numpy.int64), [ best_locs_by_resolver + [best_loc] for (best_locs_by_resolver, best_loc, _) in outcomes ],
+			taxonomy.most_specific_taxa(chunk))
+		processed += len(chunk)
+		resolved += sum(found for (_, _, found) in outcomes)
+		print(f"\r{processed + data.skipped}/{tot}", end="")
+		errors.drain(stats)
 	print()
 
 	# Write results
 	print("Writing out results")
 	#results = [ { "gbifID": k, "resolutions": [ r.fields() for r in v ] } for (k, v) in resolver.results.items() ] # JSON
-	header = ["gbifID"] + [ resolver.name for resolver in process.RESOLVERS ] + ["best", "species"]
-	pandas.DataFrame(results, columns=header).to_csv(config.get("output", "results"), sep="\t", index=False)
-	with open(config.get("output", "errors"), "w") as out:
-		for stat in stats.values():
-			for (row, msg) in stat.errors:
-				out.write(f"{stat.name}: {msg} for row:\n{row}\n\n")
-	print(f"Overall: {processed} rows processed, {resolved} resolved, {skipped} skipped")
+	results.close()
+	errors.close(stats)
+	if provenance_filter is not None: provenance_filter.close()
+	others = taxon_filter.others if taxon_filter is not None else 0
+	print(f"Overall: {processed} rows processed, {resolved} resolved, {others} {'dropped' if other == 'drop' else 'skipped'} as other taxa")
 	for stat in stats.values(): stat.print()
+	if results_store is not None: results_store.print()
+	if provenance_filter is not None: provenance_filter.print()
 	mapper.summarize().to_tsv(config.get("output", "observations"))
+	if config.get("output", "species_tables", fallback=""): mapper.write_tables(config.get("output", "species_tables"))
 	duration = (datetime.datetime.now() - starttime).total_seconds()
 	print(f"Entire run took {int(duration / 60)} minutes, {int(duration % 60)} seconds")
 
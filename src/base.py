@@ -1,15 +1,44 @@
-import pandas
+import collections
+import gzip
+import io
+import queue
+import threading
 
 # Accuracy confidence
 LOW = "low"
 MODERATE = "moderate"
 HIGH = "high"
+# Confidence levels in increasing order.  Code that handles resolutions in bulk uses indices into this list.
+CONFIDENCES = [LOW, MODERATE, HIGH]
 
 class Resolution:
-	def __init__(self, location, confidence, resolver):
-		self.loc = location
-		self.conf = confidence
-		self.resolver = resolver
+	"""A statement that an observation took place at `loc`, made by `resolver` with confidence `conf`.
+
+	Resolutions are immutable and interned: there is only ever one object for each combination of location, confidence and
+	resolver, and constructing another just returns it.  They can therefore be shared freely, as in cached results, and compared
+	by identity.  `upgrade` and `downgrade` return the resolution with the adjusted confidence rather than changing this one.
+	"""
+
+	__slots__ = ("loc", "conf", "resolver")
+	interned = {}
+
+	def __new__(cls, location, confidence, resolver):
+		key = (location, confidence, resolver)
+		ret = cls.interned.get(key)
+		if ret is not None: return ret
+		ret = object.__new__(cls)
+		object.__setattr__(ret, "loc", location)
+		object.__setattr__(ret, "conf", confidence)
+		object.__setattr__(ret, "resolver", resolver)
+		# setdefault, so that threads racing to create the same resolution end up with the same object
+		return cls.interned.setdefault(key, ret)
+	def __setattr__(self, name, value):
+		raise AttributeError("Resolution is immutable")
+	def __delattr__(self, name):
+		raise AttributeError("Resolution is immutable")
+	# Copies and unpickled resolutions, such as those sent back from worker processes, are interned too.
+	def __reduce__(self):
+		return (Resolution, (self.loc, self.conf, self.resolver))
 	def __repr__(self):
 		return f"{self.loc!s} ({self.resolver}: {self.conf})"
 	def fields(self):
@@ -19,20 +48,199 @@ class Resolution:
 			"resolver": self.resolver
 		}
 	def downgrade(self):
-		if self.conf == MODERATE: self.conf = LOW
-		if self.conf == HIGH: self.conf = MODERATE
+		return Resolution(self.loc, CONFIDENCES[max(CONFIDENCES.index(self.conf) - 1, 0)], self.resolver)
 	def upgrade(self):
-		if self.conf == MODERATE: self.conf = HIGH
-		if self.conf == LOW: self.conf = MODERATE
+		return Resolution(self.loc, CONFIDENCES[min(CONFIDENCES.index(self.conf) + 1, len(CONFIDENCES) - 1)], self.resolver)
 
 # Shortcut for "we don't know"
 UNKNOWN = Resolution(None, LOW, None)
 
 class Resolver:
 	name = "base"
+	# Columns of a GBIF row that `resolve` reads
+	columns = []
+	# Whether a confident enough answer from this resolver lets the others be skipped; see `process.LocationProcessor`
+	short_circuit = False
+	# Rough cost of resolving a row, relative to the other resolvers.  Cheaper resolvers run first when evaluating lazily.
+	cost = 1
+
+	# Everything besides the row itself that `resolve` depends on, such as island definitions and tuning parameters.  Stored
+	# results are only reused while this stays the same.
+	@classmethod
+	def settings(cls):
+		return ()
+
 	def resolve(self, row):
 		return [UNKNOWN]
 
+	# Name the column of `row` that `error` was raised over.  Resolvers that know can set a `field` attribute on the exception;
+	# otherwise we guess the first of `columns` that has a value, which is the one most resolvers look at first.
+	def blame(self, row, error):
+		if getattr(error, "field", None) is not None: return error.field
+		return next((col for col in self.columns if row.get(col, "") not in ("", "NA")), None)
+
+	# Add any counters the resolver keeps for itself, such as cache statistics, to the `counters` dict, and reset them.
+	def report(self, counters):
+		pass
+
+	# Resolve a batch of rows, returning for each row either its list of resolutions or the exception raised while resolving it.
+	# Resolvers that can do better than one row at a time override this.
+	def resolve_many(self, rows):
+		ret = []
+		for row in rows:
+			try: ret.append(self.resolve(row))
+			except Exception as e: ret.append(e)
+		return ret
+
+class LRUCache:
+	"""A bounded cache that discards the least recently used entries first, and counts its hits, misses and evictions.
+
+	Any thread may use the cache.  Each process has its own copy, so the counters are collected with `report` rather than read off
+	directly.  A size of 0 disables caching.
+	"""
+
+	def __init__(self, name, size):
+		self.name = name
+		self.size = size
+		self.data = collections.OrderedDict()
+		self.lock = threading.Lock()
+		(self.hits, self.misses, self.evictions) = (0, 0, 0)
+
+	def get(self, key, compute):
+		with self.lock:
+			if key in self.data:
+				self.hits += 1
+				self.data.move_to_end(key)
+				return self.data[key]
+			self.misses += 1
+		value = compute(key)
+		if self.size <= 0: return value
+		with self.lock:
+			self.data[key] = value
+			if len(self.data) > self.size:
+				self.data.popitem(last=False)
+				self.evictions += 1
+		return value
+
+	def report(self, counters):
+		with self.lock:
+			for (what, count) in (("hits", self.hits), ("misses", self.misses), ("evictions", self.evictions)):
+				counters[f"{self.name} cache {what}"] = counters.get(f"{self.name} cache {what}", 0) + count
+			(self.hits, self.misses, self.evictions) = (0, 0, 0)
+
+class ThreadedReader(io.RawIOBase):
+	"""Read a binary stream, such as a decompressor, in a background thread, keeping a few blocks ahead of the caller.
+
+	Decompression then runs alongside whatever the caller does with the data, rather than adding to it.  Errors in the background
+	thread are raised from `readinto` once the blocks read before them have been used up.
+	"""
+
+	blocksize = 1 << 20
+
+	def __init__(self, raw, depth=4):
+		self.raw = raw
+		self.blocks = queue.Queue(depth)
+		self.pending = memoryview(b"")
+		self.finished = False
+		self.stopping = False
+		self.error = None
+		self.thread = threading.Thread(target=self.fill, daemon=True)
+		self.thread.start()
+
+	def fill(self):
+		try:
+			while not self.stopping:
+				block = self.raw.read(self.blocksize)
+				self.blocks.put(block)
+				if block == b"": return
+		except Exception as e:
+			self.error = e
+			self.blocks.put(b"")
+
+	def readable(self): return True
+
+	def readinto(self, buf):
+		if len(self.pending) == 0:
+			if self.finished: return 0
+			self.pending = memoryview(self.blocks.get())
+			if len(self.pending) == 0:
+				self.finished = True
+				if self.error is not None: raise self.error
+				return 0
+		n = min(len(buf), len(self.pending))
+		buf[:n] = self.pending[:n]
+		self.pending = self.pending[n:]
+		return n
+
+	def close(self):
+		if self.closed: return
+		# The thread may be waiting for room in the queue, so keep emptying it until the thread notices that we're stopping.
+		self.stopping = True
+		while self.thread.is_alive():
+			try: self.blocks.get(timeout=0.1)
+			except queue.Empty: pass
+		self.raw.close()
+		super().close()
+
+class ThreadedWriter(io.RawIOBase):
+	"""Write to a binary stream, such as a compressor, in a background thread, so that compression overlaps with producing the data.
+
+	An error in the background thread is raised from the next `write`, or from `close`.
+	"""
+
+	def __init__(self, raw, depth=4):
+		self.raw = raw
+		self.blocks = queue.Queue(depth)
+		self.error = None
+		self.thread = threading.Thread(target=self.drain, daemon=True)
+		self.thread.start()
+
+	def drain(self):
+		while True:
+			block = self.blocks.get()
+			if block is None: return
+			if self.error is not None: continue
+			try: self.raw.write(block)
+			except Exception as e: self.error = e
+
+	def writable(self): return True
+
+	def write(self, b):
+		if self.error is not None: raise self.error
+		self.blocks.put(bytes(b))
+		return len(b)
+
+	def close(self):
+		if self.closed: return
+		self.blocks.put(None)
+		self.thread.join()
+		try: self.raw.close()
+		finally: super().close()
+		if self.error is not None: raise self.error
+
+def open_text(path, mode="r"):
+	"""Open `path` as UTF-8 text for reading ("r") or writing ("w").  Paths ending in .gz or .zst are decompressed or compressed on
+	the fly, in a background thread; zstd compression also uses a thread per core of its own."""
+	if path.endswith(".gz"):
+		raw = gzip.open(path, mode + "b", compresslevel=6)
+	elif path.endswith(".zst"):
+		try: import zstandard
+		except ImportError: raise RuntimeError(f"Reading or writing {path!r} requires zstandard") from None
+		# Files compressed in parallel are made of many frames, which the reader must be told to carry on across.
+		if mode == "r": raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+		else: raw = zstandard.ZstdCompressor(threads=-1).stream_writer(open(path, "wb"))
+	else:
+		return open(path, mode, encoding="utf-8")
+	if mode == "r": return io.TextIOWrapper(io.BufferedReader(ThreadedReader(raw), ThreadedReader.blocksize), encoding="utf-8")
+	return io.TextIOWrapper(io.BufferedWriter(ThreadedWriter(raw), ThreadedReader.blocksize), encoding="utf-8")
+
+def write_sparse_tsv(path, rows, columns, default="", corner=""):
+	"""Write a table to `path` as TSV, given its `rows` as (name, cells) pairs, where `cells` maps the columns that have values to their
+	values.  Every other cell is written as `default`, and `corner` heads the column of row names."""
+	with open_text(path, "w") as f:
+		f.write("\t".join([corner] + columns) + "\n")
+		for (name, cells) in rows: f.write("\t".join([str(name)] + [ str(cells.get(col, default)) for col in columns ]) + "\n")
+
 class Table:
 	def __init__(self, data, rows=None, columns=None, default=None):
 		self.data = data
@@ -47,8 +255,6 @@ class Table:
 		return self.default
 
 	def to_tsv(self, file):
-		out = []
-		for rowname in self.rows:
-			row = [ self.get(rowname, colname) for colname in self.columns ]
-			out.append([rowname] + row)
-		pandas.DataFrame(out, columns=[[""] + self.columns]).to_csv(file, sep="\t", index=False)
+		cells = {}
+		for ((row, col), value) in self.data.items(): cells.setdefault(row, {})[col] = value
+		write_sparse_tsv(file, ((row, cells.get(row, {})) for row in self.rows), self.columns, self.default)
@@ -0,0 +1,77 @@
+from base import *
+
+class GadmResolver(Resolver):
+	"""Resolve observations to islands based on the GADM administrative areas that GBIF assigns from their coordinates.
+
+	GBIF fills in `level1Gid` to `level3Gid` with the ids of the province, canton and parish whose GADM polygon contains a record's
+	coordinates.  The Galápagos province is ECU.9_1, and its three cantons and eight parishes each take in one of the main islands
+	along with whatever smaller islands lie nearby.  So a parish or canton only pins the island down as far as `areas` says: only
+	the inland parishes do so with HIGH confidence, while the rest point to their main island with MODERATE or LOW confidence.  A
+	record in the province but in no listed canton or parish is placed in the Galápagos with the island unknown, as no island with
+	LOW confidence, and one with a GADM id from anywhere else in Ecuador is confidently not in the Galápagos at all.
+
+	This is a plain dictionary lookup, so it costs next to nothing beside the other resolvers, and runs first when evaluating lazily.
+	With `short_circuit`, a HIGH answer from it is then taken as final, and the other resolvers are skipped; see
+	`process.LocationProcessor`.  That can change the island chosen wherever the others would have agreed on a different one, so
+	it is off unless asked for.
+	"""
+
+	name = "gadm"
+	cost = 0
+	# Most specific first
+	columns = ["level3Gid", "level2Gid", "level1Gid"]
+	province = "ECU.9_1"
+	# GADM 4.1 ids of the Galápagos cantons and parishes, with the island each one points to and how firmly
+	areas = {
+		# Cantons
+		"ECU.9.1_1":   ("isabela", LOW),              # Isabela, which also takes in Fernandina, Darwin and Wolf
+		"ECU.9.2_1":   ("san cristobal", LOW),        # San Cristóbal, along with Española, Floreana and Genovesa
+		"ECU.9.3_1":   ("santa cruz", LOW),           # Santa Cruz, along with Santiago, Baltra, Pinta and Marchena
+		# Parishes
+		"ECU.9.1.1_1": ("isabela", MODERATE),         # Puerto Villamil
+		"ECU.9.1.2_1": ("isabela", HIGH),             # Tomás de Berlanga, in the highlands
+		"ECU.9.2.1_1": ("san cristobal", HIGH),       # El Progreso, in the highlands
+		"ECU.9.2.2_1": ("floreana", MODERATE),        # Isla Santa María, which includes Champion, Enderby and Gardner
+		"ECU.9.2.3_1": ("san cristobal", MODERATE),   # Puerto Baquerizo Moreno
+		"ECU.9.3.1_1": ("santa cruz", HIGH),          # Bellavista, in the highlands
+		"ECU.9.3.2_1": ("santa cruz", MODERATE),      # Puerto Ayora
+		"ECU.9.3.3_1": ("santa cruz", LOW),           # Santa Rosa, which includes Baltra
+	}
+	# Set from the configuration by `process.init`
+	short_circuit = False
+
+	@classmethod
+	def settings(cls):
+		return (cls.province, sorted(cls.areas.items()), cls.short_circuit)
+
+	def resolve(self, row):
+		province = row.get("level1Gid", "")
+		if province in ("", "NA"): return []
+		if province != self.province: return [Resolution(None, HIGH, self.name)]
+		for col in self.columns[:-1]:
+			area = self.areas.get(row.get(col, ""))
+			if area is not None: return [Resolution(area[0], area[1], self.name)]
+		# In the Galápagos, island unknown
+		return [Resolution(None, LOW, self.name)]
+
+gadm_tests = [
+	({"level1Gid": "", "level2Gid": "", "level3Gid": ""}, []),
+	({"level1Gid": "NA", "level2Gid": "NA", "level3Gid": "NA"}, []),
+	({"level1Gid": "ECU.18_1", "level2Gid": "ECU.18.3_1", "level3Gid": ""}, [(None, HIGH)]),
+	({"level1Gid": "ECU.9_1", "level2Gid": "", "level3Gid": ""}, [(None, LOW)]),
+	({"level1Gid": "ECU.9_1", "level2Gid": "ECU.9.2_1", "level3Gid": ""}, [("san cristobal", LOW)]),
+	({"level1Gid": "ECU.9_1", "level2Gid": "ECU.9.2_1", "level3Gid": "ECU.9.2.2_1"}, [("floreana", MODERATE)]),
+	({"level1Gid": "ECU.9_1", "level2Gid": "ECU.9.3_1", "level3Gid": "ECU.9.3.1_1"}, [("santa cruz", HIGH)]),
+	({"level1Gid": "ECU.9_1", "level2Gid": "ECU.9.1_1", "level3Gid": "ECU.9.1.9_1"}, [("isabela", LOW)]),
+]
+
+def test():
+	resolver = GadmResolver()
+	failed = 0
+	for (test, expected) in gadm_tests:
+		results = [ (res.loc, res.conf) for res in resolver.resolve(test) ]
+		if results != expected:
+			print(f"Test failure: GADM ids {test!r} yielded {results!r}; expected {expected!r}")
+			failed += 1
+	if failed > 0: print(f"Failed {failed} of {len(gadm_tests)} tests")
+	return failed == 0
@@ -1,4 +1,5 @@
 import dataclasses
+import hashlib
 import json
 import logging
 import numbers
@@ -184,6 +185,9 @@ islands = [
 
 names = { island.name for island in islands }
 
+# SHA-256 of the geometry file most recently loaded by `init`, for invalidating anything precomputed from it.
+geometry_hash = None
+
 class PolygonAccumulator:
 	def __init__(self):
 		self.finished = []
@@ -230,8 +234,11 @@ def recursive_yield_polygons(geo):
 	if ret != []: yield ret
 
 def init(osm_path):
+	global geometry_hash
 	logging.info("Loading island geometries")
-	with open(osm_path) as f: island_data = json.load(f)
+	with open(osm_path, "rb") as f: raw = f.read()
+	geometry_hash = hashlib.sha256(raw).hexdigest()
+	island_data = json.loads(raw)
 	polygons = {}
 	for feature in island_data["features"]:
 		osmid = int(feature["properties"].get("osm_id") or feature["properties"].get("osm_way_id"))
@@ -243,5 +250,5 @@ def init(osm_path):
 				logging.warning(f"Missing geometry for OSM feature {osmid}.  Island assignments may be inaccurate.")
 				continue
 			for poly in polygons[osmid]: accumulator.add(poly)
-		island.geometry.extend(accumulator.retrieve())
+		island.geometry = accumulator.retrieve()
 		logging.info(f"Built {len(island.geometry)} polygons from {len(island.osmids)} OSM ways for {island.name}")
@@ -1,4 +1,10 @@
 import functools
+import hashlib
+import logging
+import math
+import numpy
+import os
+import parsimonious.exceptions
 import parsimonious.grammar
 import parsimonious.nodes
 import re
@@ -8,6 +14,11 @@ import warnings
 from base import *
 import islands
 
+# Where the precomputed island lookup grid lives; see `init`.
+grid_path = None
+# Number of distinct coordinate strings whose parses `LatLonResolver` remembers; see `init`.
+cache_size = 100000
+
 class LatLonResolver(Resolver):
 	"""Resolve observations to island names based on latitude and longitude.
 
@@ -17,9 +28,11 @@ class LatLonResolver(Resolver):
 	"""
 
 	name = "latlon"
+	cost = 1
 	precision = 3
 	min = (-1.70, -92.30)
 	max = (1.90, -89.00)
+	columns = ["decimalLatitude", "decimalLongitude", "verbatimLatitude", "verbatimLongitude", "verbatimCoordinates", "locality"]
 
 	class BufferedMultiPolygon:
 		margin = 0.02 # Ascribe to a given island anything within 0.02 degrees of it -- about one mile in this region.
@@ -74,17 +87,19 @@ class LatLonResolver(Resolver):
 			maybe = lambda part: part[0] if isinstance(part, list) else 0.0
 			return (children[0] + maybe(children[2]) / 60.0 + maybe(children[4]) / 3600.0, children[6])
 
-		def visit_degminsec_merged(self, node, children):
+		@staticmethod
+		def merged_value(val):
 			def int_dashes(s):
 				if re.search("^-+$", s): return 0
 				return int(s)
-			val = children[0].text
 			(deg, min, sec) = ("0", "0", "0")
 			if len(val) <= 3: deg = val
 			elif len(val) <= 5: (deg, min) = (val[:-2], val[-2:])
 			else: (deg, min, sec) = (val[:-4], val[-4:-2], val[-2:])
 			(deg, min, sec) = (int_dashes(deg), int_dashes(min), int_dashes(sec))
-			return (deg + min / 60 + sec / 3600, children[2])
+			return deg + min / 60 + sec / 3600
+
+		def visit_degminsec_merged(self, node, children): return (self.merged_value(children[0].text), children[2])
 
 		def visit_degminsec(self, node, children): return children[2][0]
 
@@ -123,62 +138,159 @@ class LatLonResolver(Resolver):
 			latlon = (enclosed_latlon / plain_latlon) ws
 		""")
 		self.coord_visitor = self.CoordVisitor()
+		self.parses = LRUCache("coordinate", cache_size)
+		self.grammar_parses = 0
 
 		self.polygons = {}
 		for island in islands.islands:
 			for poly in island.geometry:
 				if island.name not in self.polygons: self.polygons[island.name] = self.BufferedMultiPolygon()
 				self.polygons[island.name].add(poly)
+		# Index the islands by bounding box, so that each point is only tested against the one or two islands it might be on.  The
+		# buffer always covers the ground, so a single tree over the buffers finds the candidates for both tests.
+		self.names = list(self.polygons.keys())
+		self.grounds = numpy.array([ self.polygons[name].ground for name in self.names ])
+		self.buffers = numpy.array([ self.polygons[name].buffer for name in self.names ])
+		shapely.prepare(self.grounds)
+		shapely.prepare(self.buffers)
+		self.index = shapely.STRtree(self.buffers)
+		self.load_grid()
+
+	# Fast paths for the most common coordinate formats, such as "-0.75/-90.28306", "0° 44' 29.16'' s", "012700s;0894000w" and
+	# "0,6262°s".  The grammar can often read the same text several ways, and settles it by trying the alternatives in order, so
+	# these patterns only accept strings that the grammar would read the same way.  Anything else is left to the grammar.
+	fast_num = r"-?(?:\d+(?:[.,]\d+)?|[.,]\d+)"
+	fast_dms = rf"""({fast_num})\s*[º°](?:\s*({fast_num})\s*['’′](?:\s*({fast_num})\s*(?:''|["”']))?)?"""
+	fast_merged = r"([0-9]{1,7})\s*"
+	# The grammar takes a period after a direction as part of it, so don't leave one behind to start the next coordinate.
+	fast_dir = r"([nsewNSEW](?:\.|(?!\.)))"
+	fast_dms_re = re.compile(rf"\s*{fast_dms}\s*{fast_dir}?")
+	fast_merged_re = re.compile(rf"\s*{fast_merged}{fast_dir}")
+	fast_decimal_re = re.compile(rf"\s*({fast_num})\s*")
+	# A pair of plain numbers needs a separator, and the first can't be an integer followed by a comma and a digit, which the
+	# grammar would read as a decimal comma.
+	fast_decimal_latlon_re = re.compile(r"\s*(-?(?:\d+\.\d+|\.\d+|\d+(?![.,]\d)))\s*[,/;\s]\s*(-?(?:\d+(?:\.\d+)?|\.\d+))\s*")
+	# Otherwise the first coordinate has to end with a direction: without one, the grammar will read the start of the second
+	# coordinate as more of the first.
+	fast_latlon_re = re.compile(
+		rf"\s*(?P<first>{fast_dms}\s*{fast_dir}|{fast_merged}{fast_dir})\s*(?:[,/;]\s*)?"
+		rf"(?P<second>{fast_dms}\s*{fast_dir}?|{fast_merged}{fast_dir}|{fast_num})\s*"
+	)
+
+	# Add up degrees, minutes and seconds exactly as the grammar does.
+	@staticmethod
+	def fast_value(deg, min, sec):
+		part = lambda s, scale: float(s.replace(",", ".")) / scale if s is not None else 0.0
+		return float(deg.replace(",", ".")) + part(min, 60.0) + part(sec, 3600.0)
+
+	# Parse a single coordinate in one of the fast path formats, giving (value, direction), or None if it isn't in one.
+	def fast_coord(self, s):
+		m = self.fast_dms_re.fullmatch(s)
+		if m is not None:
+			(deg, min, sec, dir) = m.groups()
+			return (self.fast_value(deg, min, sec), dir[0].lower() if dir is not None else None)
+		m = self.fast_merged_re.fullmatch(s)
+		if m is not None: return (self.CoordVisitor.merged_value(m[1]), m[2][0].lower())
+		m = self.fast_decimal_re.fullmatch(s)
+		if m is not None: return (self.fast_value(m[1], None, None), None)
+		return None
+
+	def fast_latlon(self, s):
+		m = self.fast_decimal_latlon_re.fullmatch(s)
+		if m is not None: return ((self.fast_value(m[1], None, None), None), (self.fast_value(m[2], None, None), None))
+		m = self.fast_latlon_re.fullmatch(s)
+		if m is not None: return (self.fast_coord(m["first"]), self.fast_coord(m["second"]))
+		return None
 
-	# Parse a single coordinate, latitude or longitude
-	def parse_human_coord(self, s, acceptable_dirs, max_abs):
-		(val, dir) = self.coord_visitor.visit(self.coord_grammar["degminsec"].parse(s))
+	# Parse `s` according to the grammar rule `rule`, "degminsec" or "latlon", giving the visitor's output, or None if it doesn't
+	# parse.  The same strings turn up over and over, so the results are cached.
+	def parse_coords(self, rule, s): return self.parses.get((rule, s), self.parse_coords_uncached)
+
+	def parse_coords_uncached(self, key):
+		(rule, s) = key
+		ret = self.fast_latlon(s) if rule == "latlon" else self.fast_coord(s)
+		if ret is not None: return ret
+		self.grammar_parses += 1
+		try: return self.coord_visitor.visit(self.coord_grammar[rule].parse(s))
+		except (parsimonious.exceptions.ParseError, parsimonious.exceptions.VisitationError): return None
+
+	# Parse a single coordinate, latitude or longitude, giving None if it's unparseable or invalid
+	def read_coord(self, s, acceptable_dirs, max_abs):
+		parsed = self.parse_coords("degminsec", s)
+		if parsed is None: return None
+		(val, dir) = parsed
 		if dir is not None:
-			if dir not in acceptable_dirs: raise RuntimeError(f"Invalid direction {dir!r}")
-			if val < 0: raise ValueError(f"Negative coordinate {val} given with direction {dir}")
+			if dir not in acceptable_dirs or val < 0: return None
 			if dir in {'s', 'w'}: val = -val
-		if val > max_abs or val < -max_abs: raise ValueError(f"Coordinate {val} outside of designated bound {max_abs}")
+		if val > max_abs or val < -max_abs: return None
 		return val
 
-	def parse_human_lat(self, s): return self.parse_human_coord(s, {'n', 's'}, 90)
+	def read_lat(self, s): return self.read_coord(s, {'n', 's'}, 90)
 
-	def parse_human_lon(self, s): return self.parse_human_coord(s, {'e', 'w'}, 180)
+	def read_lon(self, s): return self.read_coord(s, {'e', 'w'}, 180)
 
-	def parse_human_latlon(self, s):
-		((lat, latdir), (lon, londir)) = self.coord_visitor.visit(self.coord_grammar["latlon"].parse(s))
+	def read_latlon(self, s):
+		parsed = self.parse_coords("latlon", s)
+		if parsed is None: return None
+		((lat, latdir), (lon, londir)) = parsed
 		if latdir in {'e', 'w'} and londir in {'n', 's'}:
 			(lat, lon) = (lon, lat)
 			(latdir, londir) = (londir, latdir)
 		if latdir is not None:
-			if latdir not in {'n', 's'}: raise RuntimeError(f"Invalid latitude direction {latdir!r}")
-			if lat < 0: raise ValueError(f"Negative latitude {lat} given with direction {latdir}")
+			if latdir not in {'n', 's'} or lat < 0: return None
 			if latdir == 's': lat = -lat
 		if londir is not None:
-			if londir not in {'e', 'w'}: raise RuntimeError(f"Invalid longitude direction {londir!r}")
-			if lon < 0: raise ValueError(f"Negative longitude {lon} given with direction {londir}")
+			if londir not in {'e', 'w'} or lon < 0: return None
 			if londir == 'w': lon = -lon
-		if lat < -90 or lat > 90: raise ValueError(f"Latitude {lat} out of bounds")
-		if lon < -180 or lon > 180: raise ValueError(f"Longitude {lon} out of bounds")
+		if lat < -90 or lat > 90 or lon < -180 or lon > 180: return None
 		return (lat, lon)
 
+	def parse_human_lat(self, s):
+		ret = self.read_lat(s)
+		if ret is None: raise ValueError(f"Invalid latitude {s!r}")
+		return ret
+
+	def parse_human_lon(self, s):
+		ret = self.read_lon(s)
+		if ret is None: raise ValueError(f"Invalid longitude {s!r}")
+		return ret
+
+	def parse_human_latlon(self, s):
+		ret = self.read_latlon(s)
+		if ret is None: raise ValueError(f"Invalid coordinates {s!r}")
+		return ret
+
 	# Regex for extracting embedded decimal coordinates from free-text fields.
 	# Requires >=4 decimal places to avoid false positives from non-coordinate numbers.
 	locality_coord_re = re.compile(r'(-?\d+\.\d{4,})\s*[x,;/]\s*(-?\d+\.\d{4,})')
 
-	def find_coordinates(self, row):
+	def decimal_coordinates(self, row):
 		has_col = lambda name: name in row and row[name] not in ("", "NA")
 		if has_col("decimalLatitude") and has_col("decimalLongitude"):
 			try: return (float(row["decimalLatitude"]), float(row["decimalLongitude"]))
 			except: pass
+		return None
+
+	# Read the `col` field of `row` with `read`, marking any error with the field for `Resolver.blame`.
+	def read_field(self, row, col, read):
+		try: return read(row[col])
+		except Exception as e:
+			e.field = col
+			raise
+
+	def find_coordinates(self, row):
+		has_col = lambda name: name in row and row[name] not in ("", "NA")
+		coords = self.decimal_coordinates(row)
+		if coords is not None: return coords
 		if has_col("verbatimLatitude") and has_col("verbatimLongitude"):
-			try: return (self.parse_human_lat(row["verbatimLatitude"]), self.parse_human_lon(row["verbatimLongitude"]))
-			except: pass
+			(lat, lon) = (self.read_field(row, "verbatimLatitude", self.read_lat), self.read_field(row, "verbatimLongitude", self.read_lon))
+			if lat is not None and lon is not None: return (lat, lon)
 			# If the lat/lon don't parse as-is but do parse when swapped, then it's quite likely they were entered the wrong way around.
-			try: return (self.parse_human_lat(row["verbatimLongitude"]), self.parse_human_lon(row["verbatimLatitude"]))
-			except: pass
+			(lat, lon) = (self.read_field(row, "verbatimLongitude", self.read_lat), self.read_field(row, "verbatimLatitude", self.read_lon))
+			if lat is not None and lon is not None: return (lat, lon)
 		if has_col("verbatimCoordinates"):
-			try: return self.parse_human_latlon(row["verbatimCoordinates"])
-			except: pass
+			coords = self.read_field(row, "verbatimCoordinates", self.read_latlon)
+			if coords is not None: return coords
 		# Last resort: try to extract decimal coordinates embedded in the locality free-text.
 		# Catches patterns like: (-1.2069,-89.6530), auto selected -1.05851, -90.88071, -1.0605x-89.6486
 		if has_col("locality"):
@@ -188,13 +300,99 @@ class LatLonResolver(Resolver):
 				except: pass
 		return None
 
+	# Island lookup grid
+	#
+	# Since coordinates are rounded to `precision` digits and clipped to the `min`/`max` box before lookup, there are only about 12M
+	# points that `query` can ever be asked about.  We precompute the answer for each one into a grid of one-byte codes: 0 is no
+	# island, `GROUND | i + 1` is the ground of island i, plain `i + 1` is the buffer of island i alone, and `OVERLAP | k` is the k'th
+	# distinct combination of overlapping buffers.  The `codes` side table maps each code to an island bitmask and confidence, in the
+	# same form as `query_many` returns.
+
+	GROUND = 0x40
+	OVERLAP = 0x80
+	grid_version = 1
+
+	@classmethod
+	def settings(cls):
+		return (islands.geometry_hash, cls.BufferedMultiPolygon.margin, cls.precision, cls.min, cls.max, [ (island.name, island.osmids) for island in islands.islands ])
+
+	# The grid depends on the geometry file, the OSM ways that make up each island, the margin, and the grid bounds and precision.
+	@classmethod
+	def grid_file(cls):
+		h = hashlib.sha256()
+		h.update(repr((cls.grid_version, islands.geometry_hash, cls.BufferedMultiPolygon.margin, cls.precision, cls.min, cls.max)).encode())
+		for island in islands.islands: h.update(repr((island.name, island.osmids)).encode())
+		return os.path.join(grid_path, f"latlon-{h.hexdigest()[:16]}")
+
+	def grid_origin(self):
+		scale = 10 ** self.precision
+		origin = (round(self.min[0] * scale), round(self.min[1] * scale))
+		shape = (round(self.max[0] * scale) - origin[0] + 1, round(self.max[1] * scale) - origin[1] + 1)
+		return (scale, origin, shape)
+
+	def compile_grid(self):
+		if len(self.names) >= self.GROUND: raise RuntimeError(f"Too many islands ({len(self.names)}) for the lookup grid")
+		(scale, origin, shape) = self.grid_origin()
+		first_ground = numpy.full(shape, len(self.names), dtype=numpy.uint8)
+		masks = numpy.zeros(shape, dtype=numpy.uint64)
+		for (i, name) in enumerate(self.names):
+			(minlat, minlon, maxlat, maxlon) = shapely.bounds(self.buffers[i])
+			rows = numpy.arange(max(math.floor(minlat * scale), origin[0]), min(math.ceil(maxlat * scale), origin[0] + shape[0] - 1) + 1)
+			cols = numpy.arange(max(math.floor(minlon * scale), origin[1]), min(math.ceil(maxlon * scale), origin[1] + shape[1] - 1) + 1)
+			# Dividing the integer grid coordinates gives exactly the floats that `round(x, precision)` does.
+			(lats, lons) = numpy.meshgrid(rows / scale, cols / scale, indexing="ij")
+			window = (slice(rows[0] - origin[0], rows[-1] - origin[0] + 1), slice(cols[0] - origin[1], cols[-1] - origin[1] + 1))
+			masks[window][shapely.contains_xy(self.buffers[i], lats, lons)] |= numpy.uint64(1 << i)
+			first_ground[window][shapely.contains_xy(self.grounds[i], lats, lons) & (first_ground[window] == len(self.names))] = i
+		grid = numpy.zeros(shape, dtype=numpy.uint8)
+		codes = numpy.zeros((2, 256), dtype=numpy.uint64)
+		codes[1, 0] = CONFIDENCES.index(LOW)
+		for i in range(len(self.names)):
+			codes[:, self.GROUND | i + 1] = (1 << i, CONFIDENCES.index(HIGH))
+			codes[:, i + 1] = (1 << i, CONFIDENCES.index(MODERATE))
+			grid[masks == 1 << i] = i + 1
+		(combos, inverse) = numpy.unique(masks[grid == 0], return_inverse=True)
+		combos = combos[combos != 0]
+		if len(combos) > 0xff - self.OVERLAP: raise RuntimeError(f"Too many overlapping islands ({len(combos)}) for the lookup grid")
+		for (k, combo) in enumerate(combos):
+			codes[:, self.OVERLAP | k] = (combo, CONFIDENCES.index(MODERATE))
+			grid[(masks == combo) & (grid == 0)] = self.OVERLAP | k
+		on_ground = first_ground < len(self.names)
+		grid[on_ground] = self.GROUND | first_ground[on_ground] + 1
+		return (grid, codes)
+
+	# Load the grid for the current islands from `grid_path`, compiling and saving it first if there isn't one yet.
+	def load_grid(self):
+		self.grid = None
+		if grid_path is None: return
+		path = self.grid_file()
+		if not os.path.exists(path + "-grid.npy"):
+			logging.warning(f"Building island lookup grid {path}; this only happens when the islands change")
+			os.makedirs(grid_path, exist_ok=True)
+			(grid, codes) = self.compile_grid()
+			# Write to temporary files and move them into place, so that a concurrent or interrupted run never sees half a grid.
+			for (suffix, data) in (("-codes.npy", codes), ("-grid.npy", grid)):
+				with open(f"{path}{suffix}.{os.getpid()}", "wb") as f: numpy.save(f, data)
+				os.replace(f"{path}{suffix}.{os.getpid()}", path + suffix)
+		self.codes = numpy.load(path + "-codes.npy")
+		self.grid = numpy.load(path + "-grid.npy", mmap_mode="r")
+
 	@functools.cache
 	def query(self, lat, lon):
+		if self.grid is not None:
+			(scale, origin, shape) = self.grid_origin()
+			if math.isfinite(lat) and math.isfinite(lon):
+				(i, j) = (round(lat * scale) - origin[0], round(lon * scale) - origin[1])
+				if 0 <= i < shape[0] and 0 <= j < shape[1]:
+					code = self.grid[i, j]
+					return self.resolutions(int(self.codes[0, code]), int(self.codes[1, code]))
 		point = shapely.Point(lat, lon)
-		candidates = set()
-		for (name, poly) in self.polygons.items():
+		candidates = []
+		# Visit the candidates in island order, so that the result is the same as testing every island in turn.
+		for i in sorted(self.index.query(point)):
+			(name, poly) = (self.names[i], self.polygons[self.names[i]])
 			if poly.ground.contains(point): return [Resolution(name, HIGH, self.name)]
-			if poly.buffer.contains(point): candidates.add(name)
+			if poly.buffer.contains(point): candidates.append(name)
 		if len(candidates) == 0: return [Resolution(None, LOW, self.name)]
 		return [ Resolution(cand, MODERATE, self.name) for cand in candidates ]
 
@@ -205,18 +403,100 @@ class LatLonResolver(Resolver):
 		#	if argmin is None or dist < min: (min, argmin) = (dist, candidate)
 		#return argmin
 
-	def resolve(self, row):
-		coords = self.find_coordinates(row)
-		if coords is None: return []
-		(lat, lon) = coords
-		if (
+	# Vectorized equivalent of `query` for arrays of latitudes and longitudes.  For each point, this returns a bitmask of the islands
+	# in `self.names` that it belongs to and the index in `CONFIDENCES` of the confidence with which it belongs to them.
+	def query_many(self, lats, lons):
+		if self.grid is None: return self.query_polygons(lats, lons)
+		(scale, origin, shape) = self.grid_origin()
+		with numpy.errstate(invalid="ignore"):
+			(i, j) = (numpy.round(lats * scale) - origin[0], numpy.round(lons * scale) - origin[1])
+			inside = (0 <= i) & (i < shape[0]) & (0 <= j) & (j < shape[1])
+		codes = self.grid[i[inside].astype(int), j[inside].astype(int)]
+		masks = numpy.zeros(len(lats), dtype=numpy.uint64)
+		confs = numpy.zeros(len(lats), dtype=int)
+		(masks[inside], confs[inside]) = (self.codes[0, codes], self.codes[1, codes])
+		if not numpy.all(inside): (masks[~inside], confs[~inside]) = self.query_polygons(lats[~inside], lons[~inside])
+		return (masks, confs)
+
+	def query_polygons(self, lats, lons):
+		points = shapely.points(lats, lons)
+		(point_idx, island_idx) = self.index.query(points)
+		(lats, lons) = (lats[point_idx], lons[point_idx])
+		in_ground = shapely.contains_xy(self.grounds[island_idx], lats, lons)
+		in_buffer = shapely.contains_xy(self.buffers[island_idx], lats, lons)
+		bits = numpy.left_shift(numpy.uint64(1), island_idx.astype(numpy.uint64))
+		masks = numpy.zeros(len(points), dtype=numpy.uint64)
+		numpy.bitwise_or.at(masks, point_idx[in_buffer], bits[in_buffer])
+		# As in `query`, a point on the ground of an island belongs to the first such island only.
+		first_ground = numpy.full(len(points), len(self.names))
+		numpy.minimum.at(first_ground, point_idx[in_ground], island_idx[in_ground])
+		on_ground = first_ground < len(self.names)
+		masks[on_ground] = numpy.left_shift(numpy.uint64(1), first_ground[on_ground].astype(numpy.uint64))
+		confs = numpy.where(on_ground, CONFIDENCES.index(HIGH), numpy.where(masks != 0, CONFIDENCES.index(MODERATE), CONFIDENCES.index(LOW)))
+		return (masks, confs)
+
+	# Translate a result from `query_many` into the resolutions `query` would have returned.
+	@functools.cache
+	def resolutions(self, mask, conf):
+		conf = CONFIDENCES[conf]
+		ret = [ Resolution(name, conf, self.name) for (i, name) in enumerate(self.names) if mask & (1 << i) ]
+		if ret == []: return [Resolution(None, conf, self.name)]
+		return ret
+
+	def in_bounds(self, lat, lon):
+		return not (
 			lat < self.min[0] or
 			lon < self.min[1] or
 			lat > self.max[0] or
 			lon > self.max[1]
-		): return [Resolution(None, HIGH, self.name)]
+		)
+
+	def resolve(self, row):
+		coords = self.find_coordinates(row)
+		if coords is None: return []
+		(lat, lon) = coords
+		if not self.in_bounds(lat, lon): return [Resolution(None, HIGH, self.name)]
 		return self.query(round(lat, self.precision), round(lon, self.precision))
 
+	# Rows with decimal coordinates, which is most of them, are looked up all at once with `query_many`.  Anything else takes the
+	# row-by-row path through `resolve`.
+	def resolve_many(self, rows):
+		ret = [None] * len(rows)
+		(batch, lats, lons) = ([], [], [])
+		for (i, row) in enumerate(rows):
+			coords = self.decimal_coordinates(row)
+			if coords is None: continue
+			(lat, lon) = coords
+			if not self.in_bounds(lat, lon):
+				ret[i] = [Resolution(None, HIGH, self.name)]
+				continue
+			batch.append(i)
+			lats.append(round(lat, self.precision))
+			lons.append(round(lon, self.precision))
+		if batch != []:
+			# Many rows share coordinates, so only look up each distinct point once.
+			(points, inverse) = numpy.unique(numpy.array([lats, lons]).T, axis=0, return_inverse=True)
+			(masks, confs) = self.query_many(points[:, 0], points[:, 1])
+			for (i, j) in zip(batch, inverse.reshape(-1)): ret[i] = self.resolutions(int(masks[j]), int(confs[j]))
+		for (i, row) in enumerate(rows):
+			if ret[i] is not None: continue
+			try: ret[i] = self.resolve(row)
+			except Exception as e: ret[i] = e
+		return ret
+
+	def report(self, counters):
+		self.parses.report(counters)
+		counters["coordinate grammar parses"] = counters.get("coordinate grammar parses", 0) + self.grammar_parses
+		self.grammar_parses = 0
+
+def init(cache_dir, size):
+	"""Use a precomputed island lookup grid kept in `cache_dir`, building it there now if the islands have changed, and remember
+	the parses of up to `size` distinct coordinate strings."""
+	global grid_path, cache_size
+	grid_path = cache_dir or None
+	cache_size = size
+	if grid_path is not None and not os.path.exists(LatLonResolver.grid_file() + "-grid.npy"): LatLonResolver()
+
 latlon_tests = [
 	('s1°39′ w89°20′', (-1.65, -89.33333333333333)),
 	('13\' 45" s, 91° 48\' 30" w', (-0.22916666666666669, -91.80833333333334)),
@@ -317,6 +597,16 @@ lon_tests = [
 def test():
 	resolver = LatLonResolver()
 	ok = True
+	# Errors are blamed on the field being read, not just the first one with a value.
+	class FailingResolver(LatLonResolver):
+		def read_lon(self, s): raise ValueError(f"Can't read longitude {s!r}")
+	failing = FailingResolver()
+	row = {"decimalLatitude": "NA", "decimalLongitude": "-90.3.1", "verbatimLatitude": "0 30 s", "verbatimLongitude": "90 30 w"}
+	[error] = failing.resolve_many([row])
+	field = failing.blame(row, error) if isinstance(error, Exception) else None
+	if field != "verbatimLongitude":
+		print(f"Test failure: resolving {row!r} gave {error!r} over {field!r}; expected an error over 'verbatimLongitude'")
+		ok = False
 	for (test, expected) in latlon_tests:
 		result = resolver.parse_human_latlon(test)
 		if result != expected:
@@ -12,6 +12,32 @@ def normalize(s):
 	s = s.replace('\u2013', '--').replace('\u2014', '--')
 	return unicodedata.normalize("NFKD", s.casefold()).encode("ASCII", "ignore").decode()
 
+# Build a regex matching any of `words`, factored into a trie so that the regex engine only ever follows one branch per character.
+# Where one word is a prefix of another, the regex prefers the longer one.
+def trie_regex(words):
+	trie = {}
+	for word in words:
+		node = trie
+		for ch in word: node = node.setdefault(ch, {})
+		node[""] = {}
+	def build(node):
+		alts = [ re.escape(ch) + build(child) for (ch, child) in sorted(node.items()) if ch != "" ]
+		if alts == []: return ""
+		ret = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+		return f"(?:{ret})?" if "" in node else ret
+	return build(trie)
+
+# Return `s` along with every string obtained by deleting one character from it.
+def deletions(s):
+	return { s } | { s[:i] + s[i + 1:] for i in range(len(s)) }
+
+# Number of distinct field values whose scores `NameResolver` remembers; see `init`.
+cache_size = 100000
+
+def init(size):
+	global cache_size
+	cache_size = size
+
 # Simple dict wrapper for tracking and manipulating relevance scores for islands
 class ScoreMap:
 	def __init__(self):
@@ -27,6 +53,11 @@ class ScoreMap:
 	def merge(self, other):
 		for (name, score) in other.scores.items(): self.add(name, score)
 
+	def copy(self):
+		ret = ScoreMap()
+		ret.scores = dict(self.scores)
+		return ret
+
 	def inc(self, name, amount=1):
 		if name in self.scores: self.scores[name] += amount
 
@@ -66,6 +97,7 @@ class NameResolver(Resolver):
 	"""
 
 	name = "name"
+	cost = 2
 	# Columns searched in order; first column that yields a match is returned.
 	# adj is added to every score from that column before confidence is assigned
 	# (HIGH >7, MODERATE 3-7, LOW <3).
@@ -96,6 +128,7 @@ class NameResolver(Resolver):
 		"stateProvince":     -1,
 		"occurrenceRemarks": -1,
 	} #, "level3Name": -1, "level2Name": -1
+	columns = list(name_columns)
 
 	# Named places (bays, coves, towns, landmarks) that unambiguously identify a single island.
 	# All entries are pre-normalized (lowercase, ASCII) to match the output of normalize().
@@ -179,6 +212,13 @@ class NameResolver(Resolver):
 	suspicious_prepositions = {"off", "also", "by", "near", "toward", "to"}
 	place_modifiers = {"bay", "punta", "point", "bahia", "playa", "beach", "volcano", "volcan", "barrio", "cerro", "canal", "harbor"}
 
+	@classmethod
+	def settings(cls):
+		return (
+			cls.name_columns, cls.place_islands, cls.island_words, sorted(cls.suspicious_prepositions), sorted(cls.place_modifiers),
+			[ (island.name, sorted(island.aliases)) for island in islands.islands ],
+		)
+
 	def __init__(self):
 		# List of island names and aliases, split into words
 		self.name_parts = []
@@ -194,6 +234,34 @@ class NameResolver(Resolver):
 				self.name_resolve[tuple(parts)] = island.name
 		# Put names with more words first, so we match the longest possible name
 		self.name_parts.sort(key=len, reverse=True)
+		# Index the names by word count and by every string one deletion away from them.  Two strings are within edit distance 1
+		# only if deleting at most one character from each makes them equal, so looking up the deletions of a candidate finds every
+		# name it could match, plus the odd false hit (such as a transposition) for the distance check to weed out.  Each entry
+		# records the name's position in `name_parts`, so that we can pick the same name a scan through that list would.
+		self.name_lengths = sorted({ len(name) for name in self.name_parts }, reverse=True)
+		self.name_index = {}
+		for (order, name) in enumerate(self.name_parts):
+			for variant in deletions(" ".join(name)): self.name_index.setdefault((len(name), variant), []).append((order, name))
+
+		# Compile the named places into one regex, so that a single pass over a field finds all of them.  The lookahead lets matches
+		# overlap, but at any one position it only reports the longest place, so we also need to know which places are prefixes of
+		# which.  Places are numbered so that hits can be reported in dictionary order, just as testing each place in turn would.
+		self.place_regex = re.compile(f"(?=({trie_regex(self.place_islands)}))")
+		self.place_order = { place: i for (i, place) in enumerate(self.place_islands) }
+		self.place_prefixes = { place: [ p for p in self.place_islands if place.startswith(p) ] for place in self.place_islands }
+
+		# Museum data repeats the same locality strings over and over, so remember how each one scored.
+		self.scores = LRUCache("score", cache_size)
+
+	# Return the first name in `name_parts` with `length` words that is within edit distance 1 of `candidate`, with its distance.
+	def match_name(self, candidate, length):
+		ret = None
+		for variant in deletions(candidate):
+			for (order, name) in self.name_index.get((length, variant), ()):
+				if ret is not None and ret[0] < order: continue
+				distance = levenshtein.distance(candidate, " ".join(name))
+				if distance <= 1: ret = (order, name, distance)
+		return ret and ret[1:]
 
 	# Return a list containing one tuple per island name occurring in the phrase, where each tuple is (island name, prefix words, suffix words).
 	def parse_phrase(self, s):
@@ -206,12 +274,13 @@ class NameResolver(Resolver):
 		i = 0
 		while i < len(words):
 			match = False
-			for name in self.name_parts:
-				candidate = " ".join(words[i:i + len(name)])
+			for length in self.name_lengths:
+				candidate = " ".join(words[i:i + length])
 				if candidate in self.place_modifiers: continue
-				distance = levenshtein.distance(candidate, " ".join(name))
 				# We've special-cased a couple common distance-2 misspellings in islands.py as well.
-				if distance <= 1:
+				found = self.match_name(candidate, length)
+				if found is not None:
+					(name, distance) = found
 					if occurrences != []:
 						occurrences[-1][2].extend(interstitial)
 					occurrences.append((self.name_resolve[tuple(name)], interstitial, [], -2 * distance))
@@ -240,6 +309,12 @@ class NameResolver(Resolver):
 		if suffix != []: return 4
 		return 6
 
+	# Return the islands of all `place_islands` entries occurring in `s`, in dictionary order.
+	def find_places(self, s):
+		found = set()
+		for match in self.place_regex.finditer(s): found.update(self.place_prefixes[match.group(1)])
+		return [ self.place_islands[place] for place in sorted(found, key=self.place_order.get) ]
+
 	def split_phrases(self, s):
 		# Ideally, we would avoid splitting on periods that are part of an abbreviation for "island", but that seems like a lot of work for minimal gain.
 		# We also split on '--' (GBIF's hierarchical locality separator, e.g. "Santa Cruz--Playa Garrapatero")
@@ -255,35 +330,45 @@ class NameResolver(Resolver):
 		#if island == "santa cruz": return -2
 		return (None, 0)
 
+	# Score the islands mentioned in a single field value, before applying the column adjustment.
+	def score_value(self, val):
+		normalized_val = normalize(val)
+		col_results = ScoreMap()
+		# Check for named places (bays, coves, towns, landmarks) that unambiguously
+		# identify a single island.  Score 8 → HIGH confidence in resolutions().
+		for island in self.find_places(normalized_val): col_results.add(island, 8)
+		# Check for island names phrase by phrase
+		for phrase in self.split_phrases(normalized_val):
+			phrase_results = ScoreMap()
+			for (island, prefix, suffix, adjustment) in self.parse_phrase(phrase):
+				score = self.score_occurrence(prefix, suffix) + adjustment
+				(island_override, score_adj) = self.special_cases(island, prefix, suffix)
+				score += score_adj
+				if island_override is not None: island = island_override
+				#print(f"({prefix}, {island}, {suffix}) -> {score}")
+				if score > 0: phrase_results.add(island, score)
+			if len(phrase_results) > 1: phrase_results.decall()
+			col_results.merge(phrase_results)
+		col_results.keep_best()
+		return col_results
+
 	def resolve(self, row):
 		for (col, adj) in self.name_columns.items():
 			val = row.get(col, "")
 			if val in ("", "NA"): continue
-			normalized_val = normalize(val)
-			col_results = ScoreMap()
-			# Check for named places (bays, coves, towns, landmarks) that unambiguously
-			# identify a single island.  Score 8 → HIGH confidence in resolutions().
-			for (place, island) in self.place_islands.items():
-				if place in normalized_val:
-					col_results.add(island, 8)
-			# Check for island names phrase by phrase
-			for phrase in self.split_phrases(normalized_val):
-				phrase_results = ScoreMap()
-				for (island, prefix, suffix, adjustment) in self.parse_phrase(phrase):
-					score = self.score_occurrence(prefix, suffix) + adjustment
-					(island_override, score_adj) = self.special_cases(island, prefix, suffix)
-					score += score_adj
-					if island_override is not None: island = island_override
-					#print(f"({prefix}, {island}, {suffix}) -> {score}")
-					if score > 0: phrase_results.add(island, score)
-				if len(phrase_results) > 1: phrase_results.decall()
-				col_results.merge(phrase_results)
+			try: col_results = self.scores.get(val, self.score_value)
+			except Exception as e:
+				e.field = col
+				raise
 			if len(col_results) > 0:
-				col_results.keep_best()
+				col_results = col_results.copy()
 				col_results.incall(adj)
 				return col_results.resolutions()
 		return []
 
+	def report(self, counters):
+		self.scores.report(counters)
+
 name_tests = [
 	# Named-place lookup tests
 	({"locality": "academy bay",      "verbatimLocality": "", "island": ""}, {"santa cruz"}),
@@ -0,0 +1,194 @@
+import concurrent.futures
+import glob
+import numpy
+import os
+import pandas
+import shutil
+
+from base import *
+import islands
+
+class TsvResultWriter:
+	"""Write result rows to a TSV file, optionally compressed, a batch at a time as the run proceeds."""
+
+	def __init__(self, path, header):
+		self.out = open_text(path, "w")
+		self.out.write("\t".join(header) + "\n")
+
+	def write(self, frame):
+		frame.to_csv(self.out, sep="\t", index=False, header=False)
+
+	def close(self):
+		self.out.close()
+
+class ParquetResultWriter:
+	"""Write result rows to Parquet, one row group per batch, so that the results can be read back by column.
+
+	gbifIDs are stored as int64 and every other column is dictionary-encoded, since each holds one of a few dozen island names or a
+	species name that recurs throughout.  Unknown values are written as "-", as in the TSV.  With `partition`, the output is a
+	directory holding a file per best island, at best=<island>/part-0.parquet, which both pyarrow and R's arrow package read as a
+	dataset partitioned on `best`.
+	"""
+
+	def __init__(self, path, header, partition=False):
+		try:
+			import pyarrow
+			import pyarrow.parquet
+		except ImportError:
+			raise RuntimeError(f"Writing {path!r} requires pyarrow") from None
+		self.pyarrow = pyarrow
+		self.path = path
+		self.partition = partition
+		self.columns = [ col for col in header if not (partition and col == "best") ]
+		self.schema = pyarrow.schema([
+			(col, pyarrow.int64() if col == "gbifID" else pyarrow.dictionary(pyarrow.int32(), pyarrow.string())) for col in self.columns
+		])
+		self.writers = {}
+		if partition:
+			# Clear out the output of any earlier run, since this one may not write all of the same partitions.
+			if os.path.isfile(path): os.remove(path)
+			for old in glob.glob(os.path.join(path, "best=*")): shutil.rmtree(old)
+
+	def writer(self, best):
+		if best not in self.writers:
+			path = self.path
+			if self.partition:
+				path = os.path.join(self.path, f"best={best}", "part-0.parquet")
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+			self.writers[best] = self.pyarrow.parquet.ParquetWriter(path, self.schema, compression="zstd")
+		return self.writers[best]
+
+	def array(self, col, values):
+		if col == "gbifID": return self.pyarrow.array(values, self.pyarrow.int64())
+		# Categorical columns, as from `ResultBuffer`, are dictionary-encoded already.
+		if isinstance(values.dtype, pandas.CategoricalDtype): return self.pyarrow.array(values).cast(self.schema.field(col).type)
+		return self.pyarrow.array(values, self.pyarrow.string()).dictionary_encode()
+
+	def table(self, frame):
+		return self.pyarrow.Table.from_arrays([ self.array(col, frame[col]) for col in self.columns ], schema=self.schema)
+
+	def write(self, frame):
+		if not self.partition:
+			self.writer(None).write_table(self.table(frame))
+			return
+		for (best, part) in frame.groupby("best", sort=False, observed=True): self.writer(best).write_table(self.table(part))
+
+	def close(self):
+		# An empty run still leaves a file with the right columns behind.
+		if not self.partition and not self.writers: self.writer(None)
+		for writer in self.writers.values(): writer.close()
+
+class ErrorSink:
+	"""Write resolver errors out as they happen, one compact TSV line each, rather than holding them for the whole run.
+
+	Each line gives the gbifID, the resolver, the exception class, its message, and the field the resolver was reading along with
+	its value.  At the end, the rows sampled by each `process.ResolverStat` are written in full to `samples_path`, if given.
+	"""
+
+	header = ["gbifID", "resolver", "error", "message", "field", "value"]
+
+	def __init__(self, path, samples_path=None):
+		self.out = open_text(path, "w")
+		self.samples_path = samples_path
+		self.out.write("\t".join(self.header) + "\n")
+
+	# Write out and forget the errors gathered in `stats` so far.
+	def drain(self, stats):
+		for stat in stats.values():
+			for error in stat.errors: self.out.write("\t".join(" ".join(str(field).split()) for field in error) + "\n")
+			stat.errors.clear()
+
+	def close(self, stats):
+		self.drain(stats)
+		self.out.close()
+		if not self.samples_path: return
+		with open_text(self.samples_path, "w") as out:
+			for stat in stats.values():
+				for (_, gbifid, msg, row) in sorted(stat.samples, key=lambda s: int(s[1])):
+					out.write(f"{stat.name}: {msg} for row {gbifid}:\n" + "".join(f"    {col}: {val}\n" for (col, val) in row.items()) + "\n")
+
+def open_results(path, header, partition=False):
+	"""Open a writer for result rows with the columns in `header`: Parquet if `path` ends in .parquet, otherwise TSV."""
+	if path.endswith(".parquet"): return ParquetResultWriter(path, header, partition)
+	return TsvResultWriter(path, header)
+
+class ResultBuffer:
+	"""Collect result rows in compact arrays, and hand them to a result writer every `size` rows.
+
+	Each row takes a few bytes: its gbifID as an int64, a uint8 code for the island chosen by each resolver and for the best island,
+	and an int32 code for the species.  Species names are interned, so each distinct name is held once.  Full buffers are written
+	out in a background thread while the next one fills, so writing overlaps with resolving, and at most one buffer waits to be
+	written at a time.
+	"""
+
+	def __init__(self, writer, header, size):
+		self.writer = writer
+		self.header = header
+		self.size = max(size, 1)
+		# Code 0 is "-", for unknown
+		self.islands = ["-"] + [ island.name for island in islands.islands ]
+		self.island_codes = { name: i for (i, name) in enumerate(self.islands) }
+		self.species = ["-"]
+		self.species_codes = {"-": 0}
+		self.pool = concurrent.futures.ThreadPoolExecutor(1)
+		self.pending = None
+		self.start()
+
+	def start(self):
+		self.gbifids = numpy.empty(self.size, numpy.int64)
+		self.locs = numpy.empty((self.size, len(self.header) - 2), numpy.uint8)
+		self.taxa = numpy.empty(self.size, numpy.int32)
+		self.count = 0
+
+	def code(self, codes, names, name):
+		if name not in codes:
+			codes[name] = len(names)
+			names.append(name)
+		return codes[name]
+
+	# Code each of `values`, which may be nested lists, as `code` does, with "-" for None, giving an array of `dtype`.
+	def codes(self, codes, names, values, dtype):
+		values = numpy.array(values, object).reshape(-1)
+		values[pandas.isna(values)] = "-"
+		(index, distinct) = pandas.factorize(values)
+		return numpy.array([ self.code(codes, names, name) for name in distinct ], dtype)[index]
+
+	# Add a batch of rows, given their `gbifids`, their `locs`, each a list of the island chosen by each resolver followed by the best
+	# island, with None for unknown, and their `species`, also None if unknown.  Each distinct island and species is coded once.
+	def add_many(self, gbifids, locs, species):
+		n = len(gbifids)
+		loc_codes = self.codes(self.island_codes, self.islands, locs, numpy.uint8).reshape(n, self.locs.shape[1])
+		species_codes = self.codes(self.species_codes, self.species, species, numpy.int32)
+		start = 0
+		while start < n:
+			take = min(self.size - self.count, n - start)
+			(i, j) = (self.count, self.count + take)
+			self.gbifids[i:j] = gbifids[start:start + take]
+			self.locs[i:j] = loc_codes[start:start + take]
+			self.taxa[i:j] = species_codes[start:start + take]
+			(self.count, start) = (j, start + take)
+			if self.count == self.size: self.flush()
+
+	def frame(self):
+		n = self.count
+		columns = { "gbifID": self.gbifids[:n] }
+		for (j, col) in enumerate(self.header[1:-1]): columns[col] = pandas.Categorical.from_codes(self.locs[:n, j], self.islands)
+		columns[self.header[-1]] = pandas.Categorical.from_codes(self.taxa[:n], list(self.species))
+		return pandas.DataFrame(columns)
+
+	def wait(self):
+		if self.pending is not None: self.pending.result()
+		self.pending = None
+
+	def flush(self):
+		if self.count == 0: return
+		frame = self.frame()
+		self.wait()
+		self.pending = self.pool.submit(self.writer.write, frame)
+		self.start()
+
+	def close(self):
+		self.flush()
+		self.wait()
+		self.pool.shutdown()
+		self.writer.close()
@@ -1,41 +1,188 @@
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import math
+import numpy
+import pandas
+import random
+import re
+
 from base import *
+import gadm
+import islands
 import latlon
 import name
+import provenance
 
 RESOLVERS = [
 	latlon.LatLonResolver,
 	name.NameResolver,
+	gadm.GadmResolver,
 ]
 
+# The outcome of a row that nothing was resolved for: no island from each resolver, no best island, and not found
+UNRESOLVED = ([None] * len(RESOLVERS), None, False)
+
 TESTS = [
 	latlon.test,
 	name.test,
+	gadm.test,
 ]
 
 def test():
 	ok = True
-	for testfn in TESTS: ok = testfn() and ok
+	for testfn in TESTS + [prefilter_test, prioritizer_test]: ok = testfn() and ok
 	return ok
 
 class ResolverStat:
-	def __init__(self, name):
+	"""Counts of what a resolver did, gathered per chunk and merged in input order.
+
+	Errors are kept in compact form, as (gbifID, resolver, exception class, message, field, value) records, only until
+	`output.ErrorSink` writes them out.  For debugging, a uniform random sample of up to `sample_size` full rows that hit errors is
+	kept over the whole run: each error gets a key hashed from its gbifID, and the rows with the smallest keys are kept, which merges
+	across chunks and workers without bias.  Random keys would be drawn from the same state in every worker forked from the main
+	process, so the workers' samples would be correlated; hashed keys also make the sample the same from run to run.
+	"""
+
+	# Number of full rows to keep a sample of; see `init`
+	sample_size = 0
+
+	def __init__(self, name, resolver=True):
 		self.name = name
+		# Pipeline stages other than resolvers, such as the prefilter, only keep `counters`.
+		self.resolver = resolver
 		self.processed = 0
 		self.identified = 0
 		self.unknown = 0
 		self.errors = []
+		self.error_count = 0
+		self.error_classes = {}
+		self.samples = []
 		self.agreements = 0
 		self.soft_disagreements = 0
 		self.hard_disagreements = 0
+		# Resolver-specific counts, such as cache statistics, keyed by description
+		self.counters = {}
+
+	def add_error(self, row, field, error):
+		kind = type(error).__name__
+		self.error_count += 1
+		self.error_classes[kind] = self.error_classes.get(kind, 0) + 1
+		self.errors.append((row["gbifID"], self.name, kind, str(error), field or "", row.get(field, "") if field else ""))
+		if self.sample_size > 0:
+			key = int.from_bytes(hashlib.blake2b(str(row["gbifID"]).encode(), digest_size=8).digest(), "big")
+			self.samples.append((key, row["gbifID"], str(error), dict(row)))
+			if len(self.samples) > 2 * self.sample_size: self.samples = heapq.nsmallest(self.sample_size, self.samples, key=lambda s: s[0])
 
 	def print(self):
+		if not self.resolver:
+			print(f"{self.name}: " + (", ".join(f"{count} {what}" for (what, count) in self.counters.items()) or "nothing to report"))
+			return
 		print(f"{self.name} resolver: {self.processed} processed, {self.identified} identified, "
-			f"{self.unknown} unknown, {len(self.errors)} errors, {self.agreements} agree, "
+			f"{self.unknown} unknown, {self.error_count} errors, {self.agreements} agree, "
 			f"{self.hard_disagreements} hard/{self.soft_disagreements} soft disagree")
+		if self.error_classes: print("    errors: " + ", ".join(f"{count} {kind}" for (kind, count) in sorted(self.error_classes.items())))
+		if self.counters: print("    " + ", ".join(f"{count} {what}" for (what, count) in self.counters.items()))
+
+	def merge(self, other):
+		self.processed += other.processed
+		self.identified += other.identified
+		self.unknown += other.unknown
+		self.errors.extend(other.errors)
+		self.error_count += other.error_count
+		for (kind, count) in other.error_classes.items(): self.error_classes[kind] = self.error_classes.get(kind, 0) + count
+		self.samples = heapq.nsmallest(self.sample_size, self.samples + other.samples, key=lambda s: s[0])
+		self.agreements += other.agreements
+		self.soft_disagreements += other.soft_disagreements
+		self.hard_disagreements += other.hard_disagreements
+		for (what, count) in other.counters.items(): self.counters[what] = self.counters.get(what, 0) + count
 
 	@staticmethod
 	def create():
-		return { res.name: ResolverStat(res.name) for res in RESOLVERS }
+		ret = { res.name: ResolverStat(res.name) for res in RESOLVERS }
+		ret[Prefilter.name] = ResolverStat(Prefilter.name, resolver=False)
+		return ret
+
+class Prefilter:
+	"""Reject rows that plainly come from the mainland before they reach the resolvers.
+
+	Mainland rows are thrown out after resolution anyway, but not before the name resolver has spent time matching, say, "Morona-
+	Santiago" to Santiago island.  A row is rejected if its decimal coordinates lie more than `margin` degrees outside the bounds of
+	`latlon.LatLonResolver`, or if its stateProvince or county is one of the mainland `provinces` or `counties`.  Names are compared
+	ignoring case, accents and punctuation.  A row is never rejected on its names if its decimal coordinates lie within the bounds.
+
+	Nor is a row rejected at all if its locality or remarks mention the Galápagos or an old English island name, as in provenance
+	conditions D and E: old specimens may be labelled with a mainland province, such as Guayas, which the islands belonged to until
+	1973, or carry mistyped coordinates, which are just what the name resolver is there for.  For the same reason, coordinates
+	alone don't reject rows from before 1980, whose coordinates `Prioritizer` doesn't rely on either.
+
+	Rejected rows come out just like rows that nothing could be resolved for, with "-" for every island in the results.  The
+	summary counts them by reason.
+	"""
+
+	name = "prefilter"
+	columns = list(dict.fromkeys(["decimalLatitude", "decimalLongitude", "stateProvince", "county", "year"]
+		+ provenance.ProvenanceFilter.locality_columns + provenance.ProvenanceFilter.english_columns))
+	# Set from the configuration by `init`
+	margin = 1.0
+	provinces = set()
+	counties = set()
+
+	@staticmethod
+	def key(s):
+		return re.sub(r"[^a-z0-9]+", " ", name.normalize(s)).strip()
+
+	@classmethod
+	def settings(cls):
+		return (cls.margin, sorted(cls.provinces), sorted(cls.counties))
+
+	# Return the reason for rejecting `row`, or None to let it through.
+	def reject(self, row):
+		if self.galapagos(row): return None
+		(lo, hi) = (latlon.LatLonResolver.min, latlon.LatLonResolver.max)
+		if row.get("decimalLatitude", "") not in ("", "NA") and row.get("decimalLongitude", "") not in ("", "NA"):
+			try: (lat, lon) = (float(row["decimalLatitude"]), float(row["decimalLongitude"]))
+			except ValueError: (lat, lon) = (math.nan, math.nan)
+			if lo[0] <= lat <= hi[0] and lo[1] <= lon <= hi[1]: return None
+			outside = lat < lo[0] - self.margin or lon < lo[1] - self.margin or lat > hi[0] + self.margin or lon > hi[1] + self.margin
+			if outside and not Prioritizer.early(row.get("year", "")): return "coordinates"
+		if self.provinces and self.key(row.get("stateProvince", "")) in self.provinces: return "stateProvince"
+		if self.counties and self.key(row.get("county", "")) in self.counties: return "county"
+		return None
+
+	# Whether the locality or remarks of `row` say it is from the Galápagos, as provenance conditions D and E check.
+	def galapagos(self, row):
+		text = lambda cols: " ".join(row.get(col, "") for col in cols)
+		return (provenance.galapagos_re.search(text(provenance.ProvenanceFilter.locality_columns)) is not None
+			or provenance.english_island_re.search(text(provenance.ProvenanceFilter.english_columns)) is not None)
+
+prefilter_tests = [
+	({"decimalLatitude": "-0.74", "decimalLongitude": "-90.31", "stateProvince": "Pichincha"}, None),
+	({"decimalLatitude": "-0.18", "decimalLongitude": "-78.47", "year": "2010"}, "coordinates"),
+	({"decimalLatitude": "", "decimalLongitude": "", "stateProvince": "Morona-Santiago"}, "stateProvince"),
+	({"county": "Guayaquil", "locality": "Mercado central"}, "county"),
+	({"county": "Guayaquil", "locality": "Academy Bay, Santa Cruz, Galápagos"}, None),
+	# A mistyped latitude on an old specimen with a Galápagos locality
+	({"decimalLatitude": "10.75", "decimalLongitude": "-90.31", "year": "1960", "locality": "Academy Bay, Santa Cruz, Galápagos"}, None),
+	({"decimalLatitude": "10.75", "decimalLongitude": "-90.31", "year": "2010", "locality": "Academy Bay, Santa Cruz, Galápagos"}, None),
+	({"decimalLatitude": "10.75", "decimalLongitude": "-90.31", "year": "1960", "locality": "Academy Bay"}, None),
+	({"decimalLatitude": "10.75", "decimalLongitude": "-90.31", "year": "2010", "locality": "Academy Bay"}, "coordinates"),
+]
+
+def prefilter_test():
+	prefilter = Prefilter()
+	(provinces, counties) = (Prefilter.provinces, Prefilter.counties)
+	(Prefilter.provinces, Prefilter.counties) = ({ Prefilter.key("Pichincha"), Prefilter.key("Morona-Santiago") }, { Prefilter.key("Guayaquil") })
+	failed = 0
+	for (test, expected) in prefilter_tests:
+		result = prefilter.reject(test)
+		if result != expected:
+			print(f"Test failure: prefilter gave {result!r} for {test!r}; expected {expected!r}")
+			failed += 1
+	(Prefilter.provinces, Prefilter.counties) = (provinces, counties)
+	if failed > 0: print(f"Failed {failed} of {len(prefilter_tests)} prefilter tests")
+	return failed == 0
 
 class LocationProcessor:
 	"""Resolve observations to islands.
@@ -45,21 +192,59 @@ class LocationProcessor:
 	More abstract analysis, such as deciding which reolution is the best or counting species per island, should happen elsewhere.
 	"""
 
+	name = "resolvers"
+	# Set from the configuration by `init`
+	lazy = False
+
 	def __init__(self):
 		self.resolvers = [ resolver() for resolver in RESOLVERS ]
+		self.chooser = Prioritizer()
+
+	@classmethod
+	def settings(cls):
+		return (cls.lazy,)
 
 	def resolve(self, row, stats):
-		results = []
-		for resolver in self.resolvers:
+		return self.resolve_many([row], stats)[0]
+
+	# With `weights`, each of `rows` stands for weights[i] rows with the same resolver inputs, and is counted that many times in
+	# `stats`.  If one hits an error, `members(i)` gives the rows it stands for, so that the error is recorded against each of them.
+	#
+	# With `lazy`, resolvers run in order of cost, and a row stops once its outcome is settled: either `Prioritizer.decided` finds
+	# that the resolvers still to come can't change the island chosen for it, or a resolver that can short-circuit the rest gives an
+	# answer that `Prioritizer.settled` accepts as final.  The resolvers it skips don't count it as processed, and have nothing to
+	# say about it in the results, so their agreement statistics only cover the rows they saw; turn `lazy` off for full statistics.
+	# The resolutions still come back in the order of `RESOLVERS`.
+	def resolve_many(self, rows, stats, weights=None, members=None):
+		if weights is None: (weights, members) = ([1] * len(rows), lambda i: [rows[i]])
+		found = [ {} for row in rows ]
+		todo = list(range(len(rows)))
+		pending = { resolver.name for resolver in self.resolvers }
+		for resolver in sorted(self.resolvers, key=lambda resolver: resolver.cost) if self.lazy else self.resolvers:
+			pending.remove(resolver.name)
 			stat = stats[resolver.name]
-			stat.processed += 1
-			try:
-				res = resolver.resolve(row)
-				results.extend(res)
-				if res == []: stat.unknown += 1
-				else: stat.identified += 1
-			except Exception as e: stat.errors.append((row, str(e)))
-		return results
+			for (i, res) in zip(todo, resolver.resolve_many([ rows[i] for i in todo ])):
+				stat.processed += weights[i]
+				if isinstance(res, Exception):
+					field = resolver.blame(rows[i], res)
+					for member in members(i): stat.add_error(member, field, res)
+					continue
+				found[i][resolver.name] = res
+				if res == []: stat.unknown += weights[i]
+				else: stat.identified += weights[i]
+			resolver.report(stat.counters)
+			if not self.lazy or not pending: continue
+			settled = { i for i in todo if resolver.short_circuit and self.chooser.settled(rows[i], found[i].get(resolver.name, [])) }
+			if settled: stat.counters["rows short-circuited"] = stat.counters.get("rows short-circuited", 0) + int(sum(weights[i] for i in settled))
+			settled |= { i for i in todo if i not in settled and self.chooser.decided(rows[i], self.gather(found[i]), pending) }
+			for name in pending:
+				if settled: stats[name].counters["rows skipped"] = stats[name].counters.get("rows skipped", 0) + int(sum(weights[i] for i in settled))
+			todo = [ i for i in todo if i not in settled ]
+		return [ self.gather(ress) for ress in found ]
+
+	# Put together the resolutions in `found`, keyed by resolver name, in the order of `RESOLVERS`.
+	def gather(self, found):
+		return [ res for resolver in self.resolvers for res in found.get(resolver.name, []) ]
 
 class Prioritizer:
 	"""Prioritize and choose location resolutions.
@@ -70,6 +255,7 @@ class Prioritizer:
 	"""
 
 	conf_val = {LOW: 0, MODERATE: 1, HIGH: 2}
+	columns = ["year", "publisher"]
 	resolver_names = [ resolver.name for resolver in RESOLVERS ]
 
 	def best_resolution(self, resolutions):
@@ -91,24 +277,29 @@ class Prioritizer:
 	def choose(self, row, resolutions, stats):
 		if len(resolutions) == 0: return UNKNOWN
 		if len(resolutions) == 1:
-			stats[resolutions[0].resolver].agreements += 1
+			if not self.abstains(resolutions[0]): stats[resolutions[0].resolver].agreements += 1
 			return resolutions[0]
 
 		# Do some accounting -- yes, this duplicates some of `best_by_resolver`.
 		all_by_resolver = {}
 		best_by_resolver = {}
 		island_resolvers = {}
+		# Resolutions that take part in the agreement rule, by resolver; only these count towards the statistics.
+		votes_by_resolver = {}
 		for res in resolutions:
 			all_by_resolver.setdefault(res.resolver, []).append(res)
+			if self.abstains(res): continue
+			votes_by_resolver.setdefault(res.resolver, []).append(res)
 			if res.loc is not None: island_resolvers.setdefault(res.loc, set()).add(res.resolver)
+		voters = set(votes_by_resolver)
 		for (resolver, res) in all_by_resolver.items():
 			best_by_resolver[resolver] = self.best_resolution(res)
 		ret = None
 
-		# If one island was chosen by all resolvers, immediately accept it.
+		# If one island was chosen by all resolvers that took part, immediately accept it.
 		islands_chosen_by_all_resolvers = set()
 		for (island, resolvers) in island_resolvers.items():
-			if resolvers == set(self.resolver_names): islands_chosen_by_all_resolvers.add(island)
+			if resolvers == voters: islands_chosen_by_all_resolvers.add(island)
 		if len(islands_chosen_by_all_resolvers) == 1:
 			choice = islands_chosen_by_all_resolvers.pop()
 			ret = self.best_resolution([ res for res in resolutions if res.loc == choice ])
@@ -131,12 +322,345 @@ class Prioritizer:
 
 		# Update statistics and return
 		for resolver in self.resolver_names:
-			if resolver in all_by_resolver:
+			if resolver in votes_by_resolver:
 				stat = stats[resolver]
-				if ret.loc not in { res.loc for res in all_by_resolver[resolver] }:
+				if ret.loc not in { res.loc for res in votes_by_resolver[resolver] }:
 					stat.hard_disagreements += 1
-				if ret.loc != best_by_resolver[resolver].loc:
+				if ret.loc != self.best_resolution(votes_by_resolver[resolver]).loc:
 					stat.soft_disagreements += 1
 				else:
 					stat.agreements += 1
 		return ret
+
+	# Batch mode
+	#
+	# `choose_many` applies the same policy as `choose` to a whole chunk at once.  Each row's resolutions are boiled down to a
+	# bitmask per resolver and confidence of the locations given at that confidence, with bit 0 standing for "no island" and bit
+	# i + 1 for `islands.islands[i]`, plus the location and confidence of each resolver's best resolution.  Every rule of the policy
+	# then becomes an array operation over the chunk.  The choices and statistics come out exactly as from `choose`, which the test
+	# below checks.
+
+	locs = [None] + [ island.name for island in islands.islands ]
+	loc_bits = { loc: i for (i, loc) in enumerate(locs) }
+
+	@staticmethod
+	def early(year):
+		return year not in ("", "NA") and year.lstrip("-").isdigit() and int(year) < 1980
+
+	# The agreement rule asks for an island that all resolvers chose, among those that said anything, except that GADM answers which
+	# only place a row somewhere in the Galápagos, or guess at a canton's main island with LOW confidence, are too vague to stand
+	# against the others, and take no part.
+	def abstains(self, res):
+		return res.resolver == "gadm" and (res.loc is None or res.conf == LOW)
+
+	# Whether `resolutions`, from a resolver that can short-circuit the rest, are good enough to settle the choice for `row` without
+	# consulting the others.  Unlike `decided`, this is a judgement call: the others might have chosen differently.  A HIGH island
+	# is taken as final, unless the policy would hand the row to the name resolver for its year or to the lat/lon resolver for its
+	# publisher.
+	def settled(self, row, resolutions):
+		if not any(res.loc is not None and res.conf == HIGH for res in resolutions): return False
+		return not self.early(row.get("year", "")) and row.get("publisher", "") != "iNaturalist.org"
+
+	# Whether the location that `choose` picks for `row` is already fixed by `resolutions`, whatever the resolvers named in `pending`
+	# go on to add.  That is so if some resolver gave exactly one resolution, which takes part in the agreement rule, so that no
+	# other island can be agreed on, and each of the special cases either can't apply or would pick the same location, as far as
+	# can be told from the resolvers they look at.  Failing those, the highest confidence wins, so its resolution must also be HIGH,
+	# with no resolver ahead of it in `resolver_names` still to come or as confident.
+	def decided(self, row, resolutions, pending):
+		by_resolver = {}
+		for res in resolutions: by_resolver.setdefault(res.resolver, []).append(res)
+		unknown = object()
+		# Whether `resolver` said anything, or None if it has yet to run, and the location of its best resolution if known
+		def best(resolver):
+			if resolver in pending: return (None, unknown)
+			if resolver not in by_resolver: return (False, unknown)
+			return (True, self.best_resolution(by_resolver[resolver]).loc)
+		# True if all of `conds` hold, False if any fails, and None if that depends on resolvers yet to run
+		def all_of(*conds):
+			return False if False in conds else None if None in conds else True
+		def best_is(resolver, loc):
+			(has, best_loc) = best(resolver)
+			return has and best_loc == loc
+		((has_latlon, latlon_loc), (has_name, name_loc)) = (best("latlon"), best("name"))
+		# The special cases in order, with whether each applies and what it would pick
+		rules = [
+			(all_of(best_is("latlon", "espanola"), best_is("name", "gardner")), "espanola"),
+			(all_of(self.early(row.get("year", "")), has_name), name_loc),
+			(all_of(row.get("publisher", "") == "iNaturalist.org", has_latlon), latlon_loc),
+		]
+		for (resolver, ress) in by_resolver.items():
+			if len(ress) != 1 or self.abstains(ress[0]): continue
+			loc = ress[0].loc
+			for (applies, pick) in rules:
+				if applies is False: continue
+				if pick is unknown or pick != loc: break
+				if applies: return True
+			else:
+				ahead = self.resolver_names[:self.resolver_names.index(resolver)]
+				if ress[0].conf == HIGH and not any(other in pending or any(res.conf == HIGH for res in by_resolver.get(other, [])) for other in ahead):
+					return True
+		return False
+
+	# Given a frame of `rows` and the list of resolutions for each, return for each row the chosen resolution along with the best
+	# resolution from each resolver in `resolver_names`, or UNKNOWN for resolvers that had nothing to say.  As in
+	# `LocationProcessor.resolve_many`, each row is counted `weights[i]` times in `stats`.
+	def choose_many(self, rows, resolutions, stats, weights=None):
+		(n, nres) = (len(resolutions), len(self.resolver_names))
+		weights = numpy.ones(n, int) if weights is None else numpy.asarray(weights)
+		resolver_index = { resolver: k for (k, resolver) in enumerate(self.resolver_names) }
+		conf_index = { conf: c for (c, conf) in enumerate(CONFIDENCES) }
+		masks = [ [ [0] * n for conf in CONFIDENCES ] for resolver in self.resolver_names ]
+		best_loc = [ [0] * n for resolver in self.resolver_names ]
+		best_conf = [ [-1] * n for resolver in self.resolver_names ]
+		# The same for just the resolutions that take part in the agreement rule, as in `abstains`
+		votes = [ [0] * n for resolver in self.resolver_names ]
+		vote_loc = [ [0] * n for resolver in self.resolver_names ]
+		vote_conf = [ [-1] * n for resolver in self.resolver_names ]
+		count = [0] * n
+		for (i, ress) in enumerate(resolutions):
+			count[i] = len(ress)
+			for res in ress:
+				(k, c, bit) = (resolver_index[res.resolver], conf_index[res.conf], self.loc_bits[res.loc])
+				masks[k][c][i] |= 1 << bit
+				if c > best_conf[k][i]: (best_loc[k][i], best_conf[k][i]) = (bit, c)
+				if self.abstains(res): continue
+				votes[k][i] |= 1 << bit
+				if c > vote_conf[k][i]: (vote_loc[k][i], vote_conf[k][i]) = (bit, c)
+		(masks, best_loc, best_conf, count) = (numpy.array(masks, numpy.uint64), numpy.array(best_loc), numpy.array(best_conf), numpy.array(count))
+		(votes, vote_loc, voted) = (numpy.array(votes, numpy.uint64), numpy.array(vote_loc), numpy.array(vote_conf) >= 0)
+		row_index = numpy.arange(n)
+		has = best_conf >= 0
+		multi = count > 1
+
+		# Without any other rule, the result is the first resolution with the highest confidence.  Resolutions come in resolver order,
+		# so that's the best resolution of the first resolver whose best is as confident as any.
+		ret_conf = best_conf.max(axis=0)
+		ret_res = numpy.argmax(best_conf == ret_conf, axis=0)
+		ret_loc = best_loc[ret_res, row_index]
+
+		# If one island was chosen by all resolvers that took part, the most confident resolution for it.
+		agreed = numpy.bitwise_and.reduce(numpy.where(voted, votes, ~numpy.uint64(0)), axis=0) & ~numpy.uint64(1)
+		single = multi & (agreed != 0) & ((agreed & (agreed - numpy.uint64(1))) == 0)
+		# The island's mask is a power of two, which a double holds exactly.
+		agreed_loc = numpy.log2(numpy.where(single, agreed, 1).astype(float)).astype(int)
+		agreed_confs = numpy.full((nres, n), -1)
+		for c in range(len(CONFIDENCES)): agreed_confs[(masks[:, c] & agreed) != 0] = c
+		agreed_conf = agreed_confs.max(axis=0)
+		agreed_res = numpy.argmax(agreed_confs == agreed_conf, axis=0)
+
+		# Otherwise the special cases, in order.
+		def best_of(resolver):
+			k = resolver_index.get(resolver)
+			if k is None: return (numpy.zeros(n, bool), numpy.zeros(n, int))
+			return (has[k], best_loc[k])
+		(has_latlon, latlon_loc) = best_of("latlon")
+		(has_name, name_loc) = best_of("name")
+		rest = multi & ~single
+		espanola = rest & has_latlon & has_name & (latlon_loc == self.loc_bits["espanola"]) & (name_loc == self.loc_bits["gardner"])
+		years = rows["year"] if "year" in rows else [""] * n
+		early = rest & ~espanola & has_name & numpy.array([ self.early(year) for year in years ], bool)
+		inaturalist = rest & ~espanola & ~early & has_latlon & (numpy.asarray(rows["publisher"] if "publisher" in rows else [""] * n) == "iNaturalist.org")
+
+		for (chosen, resolver) in ((espanola, "latlon"), (early, "name"), (inaturalist, "latlon")):
+			if not chosen.any(): continue
+			k = resolver_index[resolver]
+			(ret_loc[chosen], ret_conf[chosen], ret_res[chosen]) = (best_loc[k, chosen], best_conf[k, chosen], k)
+		(ret_loc[single], ret_conf[single], ret_res[single]) = (agreed_loc[single], agreed_conf[single], agreed_res[single])
+
+		# Update statistics and return, leaving out resolutions that took no part in the agreement rule
+		ret_bit = numpy.left_shift(numpy.uint64(1), ret_loc.astype(numpy.uint64))
+		counted = (count == 1) & voted[ret_res, row_index]
+		lone = numpy.bincount(ret_res[counted], weights[counted], minlength=nres)
+		for (k, resolver) in enumerate(self.resolver_names):
+			stat = stats[resolver]
+			present = multi & voted[k]
+			soft = present & (ret_loc != vote_loc[k])
+			stat.hard_disagreements += int(weights[present & ((votes[k] & ret_bit) == 0)].sum())
+			stat.soft_disagreements += int(weights[soft].sum())
+			stat.agreements += int(weights[present & ~soft].sum()) + int(lone[k])
+		ret = []
+		for i in range(n):
+			best = [ Resolution(self.locs[best_loc[k, i]], CONFIDENCES[best_conf[k, i]], resolver) if has[k, i] else UNKNOWN for (k, resolver) in enumerate(self.resolver_names) ]
+			chosen = UNKNOWN if count[i] == 0 else Resolution(self.locs[ret_loc[i]], CONFIDENCES[ret_conf[i]], self.resolver_names[ret_res[i]])
+			ret.append((chosen, best))
+		return ret
+
+def prioritizer_test(cases=20000):
+	"""Check that `Prioritizer.choose_many` makes the same choices and counts as `Prioritizer.choose`, over random cases."""
+	rng = random.Random(1)
+	chooser = Prioritizer()
+	locs = [None, "espanola", "gardner", "floreana", "santa cruz"]
+	(rows, resolutions) = ([], [])
+	for i in range(cases):
+		rows.append({ "year": rng.choice(["", "NA", "1950", "2000", "-5"]), "publisher": rng.choice(["", "iNaturalist.org"]) })
+		resolutions.append([
+			Resolution(loc, rng.choice(CONFIDENCES), resolver)
+			for resolver in chooser.resolver_names for loc in rng.sample(locs, rng.choice([0, 0, 1, 1, 2, 3]))
+		])
+	(scalar_stats, batch_stats) = (ResolverStat.create(), ResolverStat.create())
+	scalar = [ chooser.choose(row, res, scalar_stats) for (row, res) in zip(rows, resolutions) ]
+	batch = chooser.choose_many(pandas.DataFrame(rows), resolutions, batch_stats)
+	ok = True
+	for (row, res, expected, (chosen, best)) in zip(rows, resolutions, scalar, batch):
+		best_by_resolver = chooser.best_by_resolver(res)
+		if chosen is not expected or best != [ best_by_resolver.get(resolver, UNKNOWN) for resolver in chooser.resolver_names ]:
+			print(f"Test failure: batch prioritizer chose {chosen!r} from {best!r} for {res!r} with {row!r}; expected {expected!r}")
+			ok = False
+	counts = lambda stat: (stat.agreements, stat.soft_disagreements, stat.hard_disagreements)
+	for (name, stat) in scalar_stats.items():
+		if counts(stat) != counts(batch_stats[name]):
+			print(f"Test failure: batch prioritizer counted {counts(batch_stats[name])} for {name}; expected {counts(stat)}")
+			ok = False
+	# GADM's vaguer answers don't stand in the way of the other resolvers agreeing, and aren't counted as agreeing or disagreeing.
+	row = {"year": "2005", "publisher": ""}
+	latlon_name = [Resolution("baltra", MODERATE, "latlon"), Resolution("santa cruz", MODERATE, "latlon"), Resolution("santa cruz", MODERATE, "name")]
+	for (extra, gadm_counts) in (
+		([], (0, 0, 0)),
+		([Resolution(None, LOW, "gadm")], (0, 0, 0)),
+		([Resolution(None, HIGH, "gadm")], (0, 0, 0)),
+		([Resolution("san cristobal", LOW, "gadm")], (0, 0, 0)),
+		([Resolution("santa cruz", MODERATE, "gadm")], (1, 0, 0)),
+	):
+		res = latlon_name + extra
+		expected = {"latlon": (0, 1, 0), "name": (1, 0, 0), "gadm": gadm_counts}
+		(scalar_stats, batch_stats) = (ResolverStat.create(), ResolverStat.create())
+		(chosen, _) = chooser.choose_many(pandas.DataFrame([row]), [res], batch_stats)[0]
+		for (choice, stats) in ((chooser.choose(row, res, scalar_stats), scalar_stats), (chosen, batch_stats)):
+			if choice.loc != "santa cruz":
+				print(f"Test failure: prioritizer chose {choice!r} from {res!r}; expected santa cruz")
+				ok = False
+			if { name: counts(stats[name]) for name in expected } != expected:
+				print(f"Test failure: prioritizer counted {({ name: counts(stats[name]) for name in expected })} for {res!r}; expected {expected}")
+				ok = False
+	# A lone GADM answer that abstains isn't counted either.
+	(scalar_stats, batch_stats) = (ResolverStat.create(), ResolverStat.create())
+	chooser.choose(row, [Resolution(None, LOW, "gadm")], scalar_stats)
+	chooser.choose_many(pandas.DataFrame([row]), [[Resolution(None, LOW, "gadm")]], batch_stats)
+	for stats in (scalar_stats, batch_stats):
+		if counts(stats["gadm"]) != (0, 0, 0):
+			print(f"Test failure: prioritizer counted {counts(stats['gadm'])} for a lone abstaining GADM answer; expected (0, 0, 0)")
+			ok = False
+	# Whenever `decided` says that the resolvers yet to run can't change the choice, they don't.
+	stats = ResolverStat.create()
+	for (row, res, expected) in zip(rows, resolutions, scalar):
+		pending = set(rng.sample(chooser.resolver_names, rng.randrange(len(chooser.resolver_names))))
+		so_far = [ r for r in res if r.resolver not in pending ]
+		if chooser.decided(row, so_far, pending) and chooser.choose(row, so_far, stats).loc != expected.loc:
+			print(f"Test failure: prioritizer took {so_far!r} as decided for {row!r}, but chose {expected!r} from {res!r}")
+			ok = False
+	return ok
+
+class ChunkProcessor:
+	"""Resolve a chunk of GBIF rows and choose the best island for each.
+
+	This bundles a `LocationProcessor` and `Prioritizer` so that a chunk of rows can be handed to a worker process as a unit.  For each
+	row, it returns the best location from each resolver, the overall best location, and whether anything was resolved at all.
+
+	Rows that agree on every column in `input_columns` must come out the same, and many do, such as a museum lot of finches all from
+	"Academy Bay".  So only the first row with each combination of those columns is resolved, and its outcome is copied to the rest,
+	which are still counted in the statistics as if each had been resolved.
+	"""
+
+	def __init__(self):
+		self.prefilter = Prefilter()
+		self.resolver = LocationProcessor()
+		self.chooser = Prioritizer()
+
+	def process(self, chunk, stats):
+		(_, first, inverse, weights) = numpy.unique(signatures(chunk), return_index=True, return_inverse=True, return_counts=True)
+		# Keep the distinct rows in input order, so that errors are reported in much the same order as without grouping.
+		order = numpy.argsort(first)
+		(first, weights, inverse) = (first[order], weights[order], numpy.argsort(order)[inverse.reshape(-1)])
+		rows = [ row for (_, row) in chunk.iloc[first].iterrows() ]
+		# Rejected rows come out as if nothing had been resolved.
+		outcomes = [UNRESOLVED] * len(rows)
+		counters = stats[Prefilter.name].counters
+		keep = []
+		for (i, (row, weight)) in enumerate(zip(rows, weights)):
+			reason = self.prefilter.reject(row)
+			if reason is None: keep.append(i)
+			else: counters[f"rejected as mainland by {reason}"] = counters.get(f"rejected as mainland by {reason}", 0) + int(weight)
+		if keep == []: return [ outcomes[i] for i in inverse ]
+		(distinct, weights) = (chunk.iloc[first[keep]], weights[keep])
+		members = lambda i: [ row for (_, row) in chunk.iloc[numpy.flatnonzero(inverse == keep[i])].iterrows() ]
+		resolutions = self.resolver.resolve_many([ rows[i] for i in keep ], stats, weights, members)
+		chosen = self.chooser.choose_many(distinct, resolutions, stats, weights)
+		for (i, (choice, best)) in zip(keep, chosen): outcomes[i] = ([ res.loc for res in best ], choice.loc, choice != UNKNOWN)
+		return [ outcomes[i] for i in inverse ]
+
+# Every column that can affect a row's outcome, in a fixed order
+def input_columns():
+	return list(dict.fromkeys(col for cls in RESOLVERS + [Prefilter, Prioritizer] for col in cls.columns))
+
+# Hash the `input_columns` of each row in `chunk`, so that rows with the same hash get the same outcome.  Columns missing from the
+# input count as empty.
+def signatures(chunk):
+	return pandas.util.hash_pandas_object(chunk.reindex(columns=input_columns(), fill_value=""), index=False).to_numpy()
+
+def init(config):
+	"""Load the island geometry and any precomputed lookup data named in `config`."""
+	islands.init(config.get("input", "geometry"))
+	latlon.init(config.get("cache", "directory", fallback=""), config.getint("cache", "coordinates", fallback=latlon.cache_size))
+	name.init(config.getint("cache", "names", fallback=name.cache_size))
+	ResolverStat.sample_size = config.getint("output", "error_sample", fallback=ResolverStat.sample_size)
+	gadm.GadmResolver.short_circuit = config.getboolean("gadm", "short_circuit", fallback=gadm.GadmResolver.short_circuit)
+	LocationProcessor.lazy = config.getboolean("resolvers", "lazy", fallback=LocationProcessor.lazy)
+	Prefilter.margin = config.getfloat("prefilter", "margin", fallback=Prefilter.margin)
+	(Prefilter.provinces, Prefilter.counties) = (
+		{ Prefilter.key(value) for value in re.split(r"[,\n]", config.get("prefilter", option, fallback="")) if value.strip() != "" }
+		for option in ("provinces", "counties")
+	)
+
+# Each worker process builds its own resolvers once, in `init_worker`, and reuses them for every chunk it is sent.
+worker = None
+
+def init_worker(config):
+	global worker
+	init(config)
+	worker = ChunkProcessor()
+
+def process_in_worker(chunk):
+	stats = ResolverStat.create()
+	return (worker.process(chunk, stats), stats)
+
+def process_chunks(chunks, stats, workers, config, store=None, skip=None):
+	"""Process a stream of chunks, yielding each chunk along with its results in input order.
+
+	With more than one worker, chunks are farmed out to a process pool.  We only keep a couple of chunks per worker in flight so that
+	memory stays bounded, and merge each chunk's statistics into `stats` in order so that the totals and error listing come out
+	exactly as they would from a single process.  Given a `store.ResultStore`, rows it already has outcomes for are served from
+	it rather than resolved, and so don't count towards the resolver statistics.  Given a `skip` function, which takes a chunk and
+	returns a boolean array, the rows it picks aren't resolved at all, and come out as if nothing could be resolved for them.
+	"""
+	def start(chunk):
+		stored = store.lookup(chunk) if store is not None else [None] * len(chunk)
+		if skip is not None: stored = [ UNRESOLVED if skipped else outcome for (outcome, skipped) in zip(stored, skip(chunk)) ]
+		return (chunk, stored, chunk[[ outcome is None for outcome in stored ]])
+	def finish(chunk, stored, todo, results, chunk_stats):
+		for (name, stat) in chunk_stats.items(): stats[name].merge(stat)
+		if store is not None: store.save(todo, results, { error[0] for stat in chunk_stats.values() for error in stat.errors })
+		fresh = iter(results)
+		return (chunk, [ outcome if outcome is not None else next(fresh) for outcome in stored ])
+	# Resolvers take a while to set up, so we don't start any until some row actually needs resolving.
+	if workers <= 1:
+		processor = None
+		for chunk in chunks:
+			(chunk, stored, todo) = start(chunk)
+			chunk_stats = ResolverStat.create()
+			if len(todo) == 0:
+				yield finish(chunk, stored, todo, [], chunk_stats)
+				continue
+			if processor is None: processor = ChunkProcessor()
+			yield finish(chunk, stored, todo, processor.process(todo, chunk_stats), chunk_stats)
+		return
+	with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker, initargs=(config,)) as pool:
+		pending = collections.deque()
+		def finish_next():
+			(chunk, stored, todo, future) = pending.popleft()
+			if future is None: return finish(chunk, stored, todo, [], ResolverStat.create())
+			return finish(chunk, stored, todo, *future.result())
+		for chunk in chunks:
+			(chunk, stored, todo) = start(chunk)
+			pending.append((chunk, stored, todo, pool.submit(process_in_worker, todo) if len(todo) > 0 else None))
+			if len(pending) >= 2 * workers: yield finish_next()
+		while pending: yield finish_next()
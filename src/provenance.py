@@ -0,0 +1,111 @@
+import numpy
+import pandas
+import re
+
+from base import *
+
+# All common spellings of Galápagos: Galapagos, Galápagos, Galpagos, etc.
+galapagos_re = re.compile(r"al[aá]?pag", re.IGNORECASE)
+# Old English island names, as used in pre-GPS museum collections, which condition D would miss.
+english_island_re = re.compile("|".join([
+	r"\balbemarle\b",         # Isabela
+	r"\bnarborough\b",        # Fernandina
+	r"\bindefatigable\b",     # Santa Cruz
+	r"\bchatham island\b",    # San Cristóbal
+	r"\bcharles island\b",    # Floreana
+	r"\bjames island\b",      # Santiago
+	r"\btower island\b",      # Genovesa
+	r"\bbindloe\b",           # Marchena
+	r"\babingdon\b",          # Pinta
+	r"\bjervis island\b",     # Rábida
+	r"\bbarrington island\b", # Santa Fé
+	r"\bculpepper\b",         # Darwin
+	r"\bwenman\b",            # Wolf
+	r"\bnorth seymour\b",     # North Seymour
+	r"\bsouth seymour\b",     # Baltra / South Seymour
+	r"\bduncan island\b",     # Pinzón
+]), re.IGNORECASE)
+
+class ProvenanceFilter:
+	"""Separate genuine Galápagos records from mainland contamination, as the R pipelines did after reading back the results.
+
+	Resolved rows are kept if their decimal longitude, if any, is no further east than `cutoff`, and any of these holds:
+
+	  A. the lat/lon resolver placed them on an island;
+	  B. GBIF's GADM level-1 id is ECU.9_1, the Galápagos province;
+	  C. stateProvince says Galápagos;
+	  D. one of the locality, county or remarks fields mentions Galápagos;
+	  E. locality, verbatimLocality or island holds an old English island name.
+
+	Kept rows go to `specimens_path`.  Unresolved rows go to `unresolved_path` if they satisfy C along with one of B, D or E, since a
+	mislabelled stateProvince alone would let mainland records through.  Both files hold the input columns of each row followed by
+	the result columns, and are written a chunk at a time.
+	"""
+
+	columns = ["decimalLongitude", "level1Gid", "stateProvince", "locality", "verbatimLocality", "island", "islandGroup", "county",
+		"occurrenceRemarks", "locationRemarks"]
+	locality_columns = ["locality", "verbatimLocality", "island", "islandGroup", "county", "occurrenceRemarks", "locationRemarks"]
+	english_columns = ["locality", "verbatimLocality", "island"]
+	conditions = {
+		"A": "lat/lon resolved",
+		"B": "GADM = ECU.9_1",
+		"C": "province = Galápagos",
+		"D": "locality/county/remarks = Galápagos",
+		"E": "old English island names",
+	}
+
+	def __init__(self, specimens_path, unresolved_path, resolver_names, cutoff=-88.0):
+		self.specimens = open_text(specimens_path, "w")
+		self.unresolved = open_text(unresolved_path, "w")
+		self.resolver_names = resolver_names
+		self.cutoff = cutoff
+		self.started = False
+		self.counts = { what: 0 for what in ["resolved", "after longitude cutoff"] + list(self.conditions) + ["kept", "dropped", "unresolved"] }
+
+	# Filter the rows of `chunk`, given their outcomes from `process.process_chunks`.  Return whether each row was kept, and whether
+	# it was written out as unresolved.
+	def add(self, chunk, outcomes):
+		def col(name):
+			if name in chunk: return chunk[name]
+			return pandas.Series("", index=chunk.index)
+		def joined(names):
+			ret = col(names[0])
+			for name in names[1:]: ret = ret + " " + col(name)
+			return ret
+		results = pandas.DataFrame(
+			[ [ loc or "-" for loc in best_locs_by_resolver ] + [best_loc or "-"] for (best_locs_by_resolver, best_loc, _) in outcomes ],
+			columns=self.resolver_names + ["best"], index=chunk.index,
+		)
+		resolved = (results["best"] != "-").to_numpy()
+		lon = pandas.to_numeric(col("decimalLongitude"), errors="coerce").to_numpy()
+		pool = resolved & (numpy.isnan(lon) | (lon <= self.cutoff))
+		conditions = {
+			"A": (results["latlon"] != "-").to_numpy() if "latlon" in results else numpy.zeros(len(chunk), bool),
+			"B": (col("level1Gid") == "ECU.9_1").to_numpy(),
+			"C": col("stateProvince").str.contains(galapagos_re).to_numpy(),
+			"D": joined(self.locality_columns).str.contains(galapagos_re).to_numpy(),
+			"E": joined(self.english_columns).str.contains(english_island_re).to_numpy(),
+		}
+		kept = pool & numpy.logical_or.reduce(list(conditions.values()))
+		unresolved = ~resolved & conditions["C"] & (conditions["B"] | conditions["D"] | conditions["E"])
+		self.counts["resolved"] += int(resolved.sum())
+		self.counts["after longitude cutoff"] += int(pool.sum())
+		for (what, condition) in conditions.items(): self.counts[what] += int((pool & condition).sum())
+		self.counts["kept"] += int(kept.sum())
+		self.counts["dropped"] += int((pool & ~kept).sum())
+		self.counts["unresolved"] += int(unresolved.sum())
+		# Write even empty frames, so that the header goes out with the first chunk.
+		output = pandas.concat([chunk, results], axis=1)
+		output[kept].to_csv(self.specimens, sep="\t", index=False, header=not self.started)
+		output[unresolved].to_csv(self.unresolved, sep="\t", index=False, header=not self.started)
+		self.started = True
+		return (kept, unresolved)
+
+	def close(self):
+		self.specimens.close()
+		self.unresolved.close()
+
+	def print(self):
+		print(f"Provenance filter: {self.counts['resolved']} resolved, {self.counts['after longitude cutoff']} after longitude cutoff, "
+			f"{self.counts['kept']} kept, {self.counts['dropped']} dropped, {self.counts['unresolved']} unresolved Galápagos records")
+		print("    kept by condition: " + ", ".join(f"({what}) {desc} {self.counts[what]}" for (what, desc) in self.conditions.items()))
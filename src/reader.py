@@ -0,0 +1,146 @@
+import io
+import itertools
+import numpy
+import pandas
+import xml.etree.ElementTree
+import zipfile
+
+from base import *
+
+class GbifReader:
+	"""Stream a GBIF occurrence extract in bounded chunks.
+
+	Concatenated GBIF downloads can contain the same gbifID more than once.  As the old load-everything-into-a-dict approach did, we
+	pass each record on once, at the position of its first copy but with the contents of its last, without holding the whole data
+	set: a first pass over the file collects just the gbifIDs, to count the records and find those that appear more than once.  If
+	there are any, a second pass picks out the last copy of each of them, which is all that is held, so that the main pass can put
+	it in place of the first copy and skip the rest.
+
+	GBIF extracts have a couple of hundred columns, of which we only use a handful.  Given a list of `columns`, only those are
+	parsed, so reading time and memory depend on the columns we use rather than on the width of the file.  The extract may be a
+	TSV, optionally compressed with gzip or zstd; a Parquet file, such as those exported by the R scripts; or a Darwin Core Archive
+	zip as downloaded from GBIF, which is read straight out of the archive.
+
+	Given a `where` function, which takes a chunk and returns a boolean array, only the rows for which it is true are passed on, and
+	the rest are counted in `skipped`.
+	"""
+
+	def __init__(self, path, chunksize, columns=None, where=None):
+		self.path = path
+		self.chunksize = chunksize
+		self.columns = columns
+		self.where = where
+		self.skipped = 0
+		# gbifIDs are short ASCII strings, so a bytes array keeps this pass to a few bytes per row.
+		ids = numpy.concatenate([ chunk["gbifID"].to_numpy().astype("S") for chunk in self.chunks(["gbifID"]) ] or [numpy.zeros(0, "S1")])
+		(unique, counts) = numpy.unique(ids, return_counts=True)
+		duplicates = { gbifid.decode() for gbifid in unique[counts > 1] }
+		self.total = len(unique)
+		# The last copy of each record that appears more than once, by gbifID
+		self.latest = None
+		if duplicates:
+			copies = pandas.concat([ chunk[chunk["gbifID"].isin(duplicates)] for chunk in self.chunks(columns) ])
+			self.latest = copies.drop_duplicates("gbifID", keep="last").set_index("gbifID", drop=False)
+
+	def __len__(self): return self.total
+
+	def chunks(self, columns):
+		if self.path.endswith(".parquet"): return self.parquet_chunks(columns)
+		if self.path.endswith(".zip"): return self.archive_chunks(columns)
+		if columns is None: return self.tsv_chunks()
+		return self.projected_tsv_chunks(columns)
+
+	def tsv_chunks(self):
+		# on_bad_lines='skip': silently drop rows whose field count doesn't match the header.
+		# This can happen when concatenating GBIF downloads from different years that have
+		# slightly different column sets, or when a text field contains a stray tab character.
+		with open_text(self.path) as f:
+			yield from pandas.read_csv(f, sep="\t", quoting=3, dtype=str, na_filter=False, on_bad_lines='skip', chunksize=self.chunksize)
+
+	# Pandas doesn't check field counts properly when given `usecols`, so we fix up the rows ourselves before handing them over to
+	# be parsed: those with too many fields are dropped, as in `tsv_chunks`, and those with too few are padded out.
+	def projected_tsv_chunks(self, columns):
+		with open_text(self.path) as f:
+			header = list(pandas.read_csv(io.StringIO(f.readline()), sep="\t", quoting=3, dtype=str, nrows=0).columns)
+			yield from self.parse_lines(f, header, columns)
+
+	def parse_lines(self, f, header, columns):
+		wanted = set(columns) if columns is not None else set(header)
+		while True:
+			lines = list(itertools.islice(f, self.chunksize))
+			if lines == []: break
+			rows = []
+			for line in lines:
+				tabs = line.count("\t")
+				if tabs >= len(header) or line.strip(" \n") == "": continue
+				if tabs < len(header) - 1: line = line.rstrip("\n") + "\t" * (len(header) - 1 - tabs) + "\n"
+				rows.append(line)
+			if rows == []: continue
+			yield pandas.read_csv(io.StringIO("".join(rows)), sep="\t", quoting=3, dtype=str, na_filter=False, header=None, names=header,
+				usecols=lambda col: col in wanted)
+
+	# A Darwin Core Archive describes its core data file in meta.xml: where it is in the archive, how it is delimited, and the
+	# term held in each column.  GBIF's simple downloads are zips too, but hold just a TSV with a header line and no meta.xml.
+	def archive_chunks(self, columns):
+		with zipfile.ZipFile(self.path) as archive:
+			if "meta.xml" in archive.namelist(): (location, encoding, skip, header) = self.archive_layout(archive)
+			else:
+				data = [ name for name in archive.namelist() if not name.endswith("/") ]
+				if len(data) != 1: raise RuntimeError(f"{self.path!r} has no meta.xml and more than one file")
+				(location, encoding, skip, header) = (data[0], "utf-8", 1, None)
+			with archive.open(location) as raw:
+				f = io.TextIOWrapper(raw, encoding=encoding)
+				if header is None: header = f.readline().rstrip("\n").split("\t")
+				else:
+					for _ in range(skip): f.readline()
+				yield from self.parse_lines(f, header, columns)
+
+	def archive_layout(self, archive):
+		ns = "{http://rs.tdwg.org/dwc/text/}"
+		core = xml.etree.ElementTree.fromstring(archive.read("meta.xml")).find(f"{ns}core")
+		if core is None: raise RuntimeError(f"meta.xml in {self.path!r} doesn't describe a core data file")
+		# GBIF writes the delimiter as an escape sequence, as the Darwin Core text guide suggests
+		if core.get("fieldsTerminatedBy", ",").replace("\\t", "\t") != "\t" or core.get("fieldsEnclosedBy", "") != "":
+			raise RuntimeError(f"Only tab-separated, unquoted core files are supported in {self.path!r}")
+		fields = { int(field.get("index")): field.get("term") for field in core.iter(f"{ns}field") if field.get("index") is not None }
+		# Column names are the last part of each term, such as "decimalLatitude" for "http://rs.tdwg.org/dwc/terms/decimalLatitude",
+		# matching the column headers of a TSV extract.
+		header = [ fields.get(i, f"column{i}").rstrip("/#").replace("#", "/").rsplit("/", 1)[-1] for i in range(max(fields, default=-1) + 1) ]
+		return (core.find(f"{ns}files/{ns}location").text.strip(), core.get("encoding", "utf-8"), int(core.get("ignoreHeaderLines", "0")), header)
+
+	def parquet_chunks(self, columns):
+		try:
+			import pyarrow
+			import pyarrow.compute
+			import pyarrow.parquet
+		except ImportError:
+			raise RuntimeError(f"Reading {self.path!r} requires pyarrow") from None
+		f = pyarrow.parquet.ParquetFile(self.path)
+		if columns is not None: columns = [ col for col in f.schema_arrow.names if col in set(columns) ]
+		for batch in f.iter_batches(batch_size=self.chunksize, columns=columns):
+			# The resolvers work on the text of each field, as read from a TSV, so turn typed columns back into strings, and nulls into
+			# empty strings.
+			yield pandas.DataFrame({
+				name: pyarrow.compute.fill_null(col.cast(pyarrow.string()), "").to_numpy(zero_copy_only=False)
+				for (name, col) in zip(batch.schema.names, batch.columns)
+			})
+
+	def __iter__(self):
+		seen = set()
+		for chunk in self.chunks(self.columns):
+			copies = chunk["gbifID"].isin(self.latest.index).to_numpy() if self.latest is not None else None
+			if copies is not None and copies.any():
+				# The first copy of each record is replaced by its last, and the other copies are skipped.
+				first = numpy.zeros(len(chunk), dtype=bool)
+				for i in numpy.flatnonzero(copies):
+					gbifid = chunk["gbifID"].iat[i]
+					first[i] = gbifid not in seen
+					seen.add(gbifid)
+				chunk = chunk.copy()
+				chunk.iloc[first] = self.latest.loc[chunk["gbifID"][first], chunk.columns].to_numpy()
+				chunk = chunk[~copies | first]
+			if self.where is not None:
+				keep = self.where(chunk)
+				self.skipped += int(len(chunk) - keep.sum())
+				chunk = chunk[keep]
+			yield chunk
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+import pandas
+import sqlite3
+
+class ResultStore:
+	"""Remember the outcome for each row between runs, so that a re-run over a new GBIF pull only resolves new or changed rows.
+
+	Outcomes are kept in an SQLite database, keyed by gbifID along with a hash of the columns the resolvers read.  A stored outcome
+	is used only if the row's hash still matches.  The whole store is cleared when the resolvers' settings change, since any of its
+	outcomes might then be out of date.
+	"""
+
+	# Bump this whenever a change to the resolvers or the prioritizer would give any row a different outcome.
+	version = 1
+
+	def __init__(self, path, resolvers, columns):
+		if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.db = sqlite3.connect(path)
+		self.columns = columns
+		self.hits = 0
+		self.misses = 0
+		fingerprint = hashlib.sha256(repr((self.version, columns, [ (resolver.name, resolver.settings()) for resolver in resolvers ])).encode()).hexdigest()
+		with self.db:
+			self.db.execute("CREATE TABLE IF NOT EXISTS settings (fingerprint TEXT)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS outcomes (gbifid INTEGER PRIMARY KEY, signature INTEGER NOT NULL, outcome TEXT NOT NULL)")
+			if self.db.execute("SELECT fingerprint FROM settings").fetchall() != [(fingerprint,)]:
+				self.db.execute("DELETE FROM settings")
+				self.db.execute("DELETE FROM outcomes")
+				self.db.execute("INSERT INTO settings VALUES (?)", (fingerprint,))
+		self.db.execute("CREATE TEMP TABLE wanted (gbifid INTEGER PRIMARY KEY, signature INTEGER NOT NULL)")
+
+	# Hash the resolver input columns of each row in `chunk`.  Columns missing from the input count as empty.
+	def signatures(self, chunk):
+		hashes = pandas.util.hash_pandas_object(chunk.reindex(columns=self.columns, fill_value=""), index=False)
+		return hashes.to_numpy().view("int64").tolist()
+
+	# Return the stored outcome for each row in `chunk`, or None for rows that need resolving.
+	def lookup(self, chunk):
+		ids = [ int(gbifid) for gbifid in chunk["gbifID"] ]
+		with self.db:
+			self.db.execute("DELETE FROM wanted")
+			self.db.executemany("INSERT INTO wanted VALUES (?, ?)", zip(ids, self.signatures(chunk)))
+			found = dict(self.db.execute("SELECT gbifid, outcome FROM wanted JOIN outcomes USING (gbifid, signature)"))
+		self.hits += len(found)
+		self.misses += len(ids) - len(found)
+		return [ json.loads(found[gbifid]) if gbifid in found else None for gbifid in ids ]
+
+	# Store the outcomes of the rows in `chunk`, except those whose gbifIDs are in `failed`.  Rows that hit an error aren't stored
+	# so that the error is reported again on the next run.
+	def save(self, chunk, outcomes, failed):
+		records = [
+			(int(gbifid), signature, json.dumps(outcome))
+			for (gbifid, signature, outcome) in zip(chunk["gbifID"], self.signatures(chunk), outcomes)
+			if gbifid not in failed
+		]
+		with self.db: self.db.executemany("INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?)", records)
+
+	def print(self):
+		print(f"Result store: {self.hits} rows reused, {self.misses} resolved")
@@ -1,4 +1,7 @@
 import logging
+import numpy
+import os
+import pandas
 import xml.etree.ElementTree
 
 from base import *
@@ -36,6 +39,16 @@ def most_specific_taxon(row):
 			return ret
 	return None
 
+# `most_specific_taxon` for each row of `chunk` at once
+def most_specific_taxa(chunk):
+	ret = numpy.full(len(chunk), None, object)
+	for taxon in ["class", "order", "family", "genus", "species"]:
+		if taxon not in chunk: continue
+		values = chunk[taxon].to_numpy(object)
+		if taxon == "species": values = numpy.array([ synonyms.get(value, value) for value in values ], object)
+		ret = numpy.where(values != "", values, ret)
+	return ret
+
 class TaxonomicDatabase:
 	def __init__(self, file):
 		self.tree = xml.etree.ElementTree.parse(file).getroot()[0]
@@ -54,31 +67,94 @@ class TaxonomicDatabase:
 			ret[f"{genus} {species}"] = i
 		return ret
 
+class TaxonFilter:
+	"""Pick out the rows of particular taxa, named by class, order or family, so that the rest can be left out of resolution.
+
+	Each name is looked for at all three ranks, since some groups are ranked differently by different sources: recent GBIF backbones
+	make Testudines and Squamata classes, for instance, where older ones have them as orders of Reptilia.  The rows of other taxa
+	are counted in `others`.
+	"""
+
+	columns = ["class", "order", "family"]
+
+	def __init__(self, taxa):
+		self.taxa = set(taxa)
+		self.others = 0
+
+	# Return whether each row of `chunk` is of one of the taxa.
+	def __call__(self, chunk):
+		keep = numpy.zeros(len(chunk), bool)
+		for col in self.columns:
+			if col in chunk: keep |= chunk[col].isin(self.taxa).to_numpy()
+		self.others += int(len(keep) - keep.sum())
+		return keep
+
 class ObservationMapper:
-	"""Builds a table of species observed on each island for taxa of particular interest.
+	"""Count observations of each species on each island, for classes of interest, as the rows go by.
+
+	For each class, species and island seen, we keep just the number of records and the latest year among them, so memory grows with
+	the number of species-island pairs rather than with the number of rows.  Records known to be from the Galápagos but not placed
+	on an island are counted under `archipelago`.  `summarize` gives the table of bird observations by island, and `write_tables`
+	writes the record count and latest year tables for each of `classes`, as r/species_by_island.R did.
 
-	This manages species of interest and records observation counts for each species-island pair, to be written to a summary table.
+	The two name species differently.  `summarize` only counts records with a species, while `write_tables` falls back on the
+	accepted or original scientific name, as the R script did.  So records are kept apart by whether their name was the species.
 	"""
 
 	classes_of_interest = {"Aves"}
+	# Columns read by `add_many` and `most_specific_taxa`
+	columns = ["gbifID", "class", "order", "family", "genus", "species", "acceptedScientificName", "scientificName", "year"]
+	archipelago = "archipelago"
 
-	def __init__(self, dbfile):
+	def __init__(self, dbfile, classes=()):
+		# (class, species name, island, whether the name is the species) -> [record count, latest year or None]
 		self.observations = {}
+		self.classes = list(classes)
 		self.db = TaxonomicDatabase(dbfile)
 
 	def should_include(self, row):
-		return row.get("class", "") in self.classes_of_interest
+		return row.get("class", "") in self.classes_of_interest or row.get("class", "") in self.classes
 
-	def add(self, row, island):
-		if not self.should_include(row): return
-		species = row.get("species", "")
-		if species == "": return
-		if species in synonyms: species = synonyms[species]
-		self.observations.setdefault((species, island), set()).add(row["gbifID"])
+	# The species name of each of `rows` used in `write_tables`: the species if given, or failing that the accepted or original
+	# scientific name, or None.
+	@staticmethod
+	def species_names(rows):
+		ret = pandas.Series(None, rows.index, object)
+		for col in ["scientificName", "acceptedScientificName", "species"]:
+			if col in rows: ret = rows[col].where(~rows[col].isin(["", "NA"]), ret)
+		return ret
+
+	# Count the rows of `chunk`, each on the island given for it in `places`, or not at all where that is None.  Rows are grouped by
+	# class, species and island within the chunk, so that each group touches `observations` once.
+	def add_many(self, chunk, places):
+		places = numpy.asarray(places, object)
+		column = lambda rows, col: rows[col] if col in rows else pandas.Series("", rows.index)
+		keep = pandas.notna(places) & column(chunk, "class").isin(self.classes_of_interest | set(self.classes)).to_numpy()
+		if not keep.any(): return
+		rows = chunk[keep]
+		species = self.species_names(rows)
+		year = column(rows, "year")
+		frame = pandas.DataFrame({
+			"class": rows["class"],
+			"species": species,
+			"island": places[keep],
+			"named": species == column(rows, "species"),
+			"year": pandas.to_numeric(year.where(year.str.fullmatch(r"-?\d+")), errors="coerce"),
+		}).dropna(subset=["species"])
+		for (key, group) in frame.groupby(["class", "species", "island", "named"])["year"]:
+			record = self.observations.setdefault(key, [0, None])
+			record[0] += len(group)
+			latest = group.max()
+			if not pandas.isna(latest) and (record[1] is None or latest > record[1]): record[1] = int(latest)
 
 	def summarize(self):
+		table = {}
+		for ((cls, species, island, named), (count, _)) in self.observations.items():
+			if cls not in self.classes_of_interest or island == self.archipelago or not named: continue
+			species = synonyms.get(species, species)
+			table[(species, island)] = table.get((species, island), 0) + count
 		ordering = self.db.ordering()
-		observed_species = set(obs[0] for obs in self.observations.keys())
+		observed_species = set(obs[0] for obs in table.keys())
 		unknown_species = observed_species - set(ordering.keys())
 		if len(unknown_species) > 0:
 			logging.warning("Ignoring species not in taxonomic database:")
@@ -86,5 +162,35 @@ class ObservationMapper:
 			observed_species -= unknown_species
 		sorted_species = sorted(observed_species, key=lambda x: ordering[x])
 		sorted_islands = sorted(island.name for island in islands.islands)
-		table = { k: len(v) for (k, v) in self.observations.items() }
 		return Table(table, sorted_species, sorted_islands, "")
+
+	# Write <class>_record_counts.tsv and <class>_last_year.tsv to `directory` for each of `classes`, exactly as r/species_by_island.R
+	# does: a row per species placed on some island, or for the latest year, placed on some island in a known year, with a column
+	# per island it was placed on, followed by the archipelago column.  Species not seen on an island have a count of 0 there, and
+	# a latest year of NA.  The archipelago column is NA in both for species with no archipelago records, as R's left join leaves
+	# it, and species seen only in the archipelago as a whole are left out.
+	def write_tables(self, directory):
+		os.makedirs(directory, exist_ok=True)
+		by_class = {}
+		for ((cls, species, island, _), (count, year)) in self.observations.items():
+			cells = by_class.setdefault(cls, {}).setdefault(species, {})
+			if island not in cells: cells[island] = [count, year]
+			else: cells[island] = [cells[island][0] + count, max(( y for y in (year, cells[island][1]) if y is not None ), default=None)]
+		for cls in self.classes:
+			species = by_class.get(cls, {})
+			if species == {}:
+				print(f"{cls}: no records")
+				continue
+			count = lambda island: sum(cells[island][0] for cells in species.values() if island in cells)
+			islands_seen = { island for cells in species.values() for island in cells } - {self.archipelago}
+			print(f"{cls}: {sum(count(island) for island in islands_seen)} records on {len(islands_seen)} islands, "
+				f"{count(self.archipelago)} archipelago only, {len(species)} species")
+			for (what, field, default) in (("record_counts", 0, 0), ("last_year", 1, "NA")):
+				rows = []
+				for (name, cells) in sorted(species.items()):
+					values = { island: record[field] for (island, record) in cells.items() if record[field] is not None }
+					if set(values) - {self.archipelago} == set(): continue
+					values.setdefault(self.archipelago, "NA")
+					rows.append((name, values))
+				places = sorted({ island for (_, values) in rows for island in values } - {self.archipelago}) + [self.archipelago]
+				write_sparse_tsv(os.path.join(directory, f"{cls.lower()}_{what}.tsv"), rows, places, default, "species_name")